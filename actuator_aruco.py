@@ -6,16 +6,43 @@ import random
 import csv
 import os
 import argparse
+import bisect
+from capture import ThreadedCapture
+from recorder import AsyncRecorder
+import container
+import replay
+from roi_tracking import RoiTracker
+import detectors
+import aruco_core
+import calibration
+from profiler import StageProfiler
+from prediction import MarkerPredictor
+from publisher import AnglePublisher
+from pacing import PacingScheduler
 
 class Application:
+    STATUS_BAR_HEIGHT = 50
+    # Replay modes of recordings, None processes every frame as fast as the
+    # window allows (paced by pacing_rate if set)
+    #   realtime: the frames are obtained at their recorded times, scaled by replay_speed
+    #   fast: no pacing and the window is refreshed at most FAST_DISPLAY_RATE times per second
+    #   step: the next frame is processed when N or Space is pressed
+    REPLAY_MODES = ("realtime", "fast", "step")
+    FAST_DISPLAY_RATE = 5
+    STEP_WAIT_MS = 30
+
     class INPUT_TYPE(enum.Enum):
         Undefined = -1
         Camera = 0
-        CSV = 1          
+        CSV = 1
+        Container = 2
 
-    def __init__(self, name):
+    # The window is opened with the first displayed frame. Without a name, the
+    # application runs headless: nothing is displayed and no keys are read.
+    def __init__(self, name=None):
         self.name = name
-        cv2.namedWindow(self.name)
+        self.window = False
+        self.detector = None
         self.angle = 0
         self.points = [[0, 0]]*3
         self.margins = [[0, 0]]*3
@@ -27,20 +54,215 @@ class Application:
         self.perspectiveMatrix = numpy.zeros((3, 3), dtype=float)
         self.calibrated = False
         self.markers = []
+        self.raw_markers = []
+        self.actuators = list(aruco_core.ACTUATORS)
+        self.actuator_markers = []
+        self.actuator_raw_markers = []
+        self.actuator_angles = []
+        self.threaded_capture = False
+        self.capture_queue_depth = 1
+        self.async_recording = False
+        self.recording_workers = 2
+        self.recording_queue_size = 8
+        self.recording_policy = "block"
+        self.recorder = None
+        self.frame_queue = []
+        self.recording_format = "png"
+        self.output_file_csv = None
+        self.output_container = None
+        self.input_recording = None
+        self.input_prefetcher = None
+        self.prefetch_depth = 4
+        self.prefetch_workers = 2
+        self.frame_cache_size = 256 # megabytes
+        self.roi_tracking = False
+        self.roi_padding = 1.0
+        self.roi_fallback = "immediate"
+        self.detector_backend = "aruco"
+        self.backend = None
+        self.probe_frames = detectors.PROBE_FRAMES
+        self.probe_min_found = detectors.PROBE_MIN_FOUND
+        self.probe_tolerance = detectors.PROBE_TOLERANCE
+        self.probe_queue = None
+        self.probe_results = None
+        self.pyramid_scale = None
+        self.motion_prediction = False
+        self.prediction_interval = 4
+        self.prediction_threshold = 2.0
+        self.predictors = None
+        self.measured = True
+        self.publish_address = None
+        self.publisher = None
+        self.frame_number = 0
+        self.frame_timestamp = 0
+        self.pacing_rate = 0
+        self.pacing_policy = "skip"
+        self.scheduler = None
+        self.skipped_frames = 0
+        self.replay_mode = None
+        self.replay_speed = 1.0
+        self.replay_scheduler = None
+        self.replay_frames = 0
+        self.replay_start = None
+        self.step_requested = True
+        self.display_rate = 0
+        self.display_warp = True
+        self.display_time = 0
+        self.canvas = None
+        self.frame = None
+        self.calibration_cache_path = os.path.expanduser("~/.actuator_calibration.json")
+        self.calibration_cache = None
+        self.calibration_source = None
+        self.recorded_calibration = None
+        self.profiler = StageProfiler(["getFrame", "detectMarkers", "perspectiveTransform", "warp", "draw", "imshow", "recording"])
 
     def setCamera(self, source):
         self.input_source = Application.INPUT_TYPE.Camera
-        self.video_capture = cv2.VideoCapture(source)
+        if self.threaded_capture:
+            self.video_capture = ThreadedCapture(source, self.capture_queue_depth)
+        else:
+            self.video_capture = cv2.VideoCapture(source)
         self.__getFrame()
+        self.calibration_source = str(source)
+        if self.success:
+            matrix = self.__loadCalibration(self.calibration_source)
+            if matrix is not None:
+                print(f"Loaded calibration for {self.calibration_source}")
+                self.__setCalibration(matrix)
+
+    def __calibrationCache(self):
+        if self.calibration_cache is None and self.calibration_cache_path is not None:
+            self.calibration_cache = calibration.CalibrationCache(self.calibration_cache_path)
+        return self.calibration_cache
+
+    def __loadCalibration(self, source):
+        cache = self.__calibrationCache()
+        if cache is None:
+            return None
+        return cache.load(source, self.frame.shape)
+
+    def __saveCalibration(self, source):
+        cache = self.__calibrationCache()
+        if cache is not None:
+            cache.save(source, self.frame.shape, self.perspectiveMatrix if self.calibrated else None)
+
+    def __setCalibration(self, matrix):
+        if matrix is None:
+            self.calibrated = False
+        else:
+            self.perspectiveMatrix = matrix
+            self.calibrated = True
+
+    # A C key press stored without a matrix, as in older recordings. The matrix
+    # found on the previous frame is cached, so it is detected only once.
+    def __replayCalibrationToggle(self, event):
+        if self.calibrated:
+            self.calibrated = False
+            return
+        if self.frame is None:
+            return
+        source = f"{self.input_file_path}#{event}"
+        matrix = self.__loadCalibration(source)
+        if matrix is not None:
+            self.__setCalibration(matrix)
+            return
+        self.__perspectiveCalibration()
+        if self.calibrated:
+            self.__saveCalibration(source)
+
+    def captureStats(self):
+        if self.input_source == Application.INPUT_TYPE.Camera and self.threaded_capture:
+            return self.video_capture.stats()
+        return None
         
     def setInputFile(self, source):
         self.input_file_path = source
-        self.input_source = Application.INPUT_TYPE.CSV
-        self.input_file_template = source + '/' + source[source.rfind('/')+1 :]
-        self.input_file_csv = open(self.input_file_template+".csv", mode="r")
-        self.input_reader = csv.reader(self.input_file_csv)
-        next(self.input_reader)
+        self.input_recording = replay.Recording(source)
+        if self.input_recording.is_container:
+            self.input_source = Application.INPUT_TYPE.Container
+        else:
+            self.input_source = Application.INPUT_TYPE.CSV
+        # The events are read once, the frames are decoded on demand. Calibration
+        # toggles are cached by their record index in containers and by their
+        # number in CSV recordings.
+        self.input_events = []
+        toggles = 0
+        for i, (kind, value) in enumerate(self.input_recording.events()):
+            if kind == "toggle":
+                value = i if self.input_recording.is_container else toggles
+                toggles += 1
+            self.input_events.append((kind, value))
+        self.input_frame_positions = [i for i, (kind, _) in enumerate(self.input_events) if kind == "frame"]
+        self.input_frame_offsets = self.__frameOffsets()
+        self.input_position = 0
+        if self.input_prefetcher is not None:
+            self.input_prefetcher.close()
+        self.input_prefetcher = replay.FramePrefetcher(self.input_recording.readFrame, self.prefetch_depth,
+            self.prefetch_workers, int(self.frame_cache_size * (1 << 20)))
         self.loop = True
+
+    def __frameOffsets(self):
+        # Seconds from the first frame to every frame by the recorded timestamps.
+        # A frame with an unknown or earlier timestamp keeps the offset of the
+        # frame before it, so it is replayed without waiting.
+        offsets = []
+        first = None
+        offset = 0.0
+        for position in self.input_frame_positions:
+            timestamp = self.input_recording.frameTimestamp(self.input_events[position][1])
+            if timestamp > 0:
+                if first is None:
+                    first = timestamp
+                offset = max(offset, timestamp - first)
+            offsets.append(offset)
+        return offsets
+
+    def seekInput(self, frame):
+        if self.input_recording is None:
+            raise ValueError("Seeking is only supported for recordings")
+        frame = min(max(frame, 0), len(self.input_frame_positions))
+        position = self.input_frame_positions[frame] if frame < len(self.input_frame_positions) else len(self.input_events)
+        self.calibrated = False
+        previous = None
+        for kind, value in self.input_events[:position]:
+            if kind == "frame":
+                previous = value
+            elif kind == "calibration":
+                self.__setCalibration(value)
+            else:
+                if previous is not None and not self.calibrated:
+                    self.frame = self.input_recording.readFrame(previous)
+                self.__replayCalibrationToggle(value)
+        self.input_position = position
+        self.__resetPredictors()
+        if self.replay_scheduler is not None:
+            self.replay_scheduler.restart()
+
+    def __resetPredictors(self):
+        if self.predictors is not None:
+            for predictor in self.predictors:
+                predictor.reset()
+
+    def replayStats(self):
+        if self.input_prefetcher is None:
+            return None
+        stats = self.input_prefetcher.stats()
+        # The achieved rate counts the processed frames, the speed also the
+        # skipped ones, relative to the rate at which the frames were recorded
+        elapsed = time.monotonic() - self.replay_start if self.replay_start is not None else 0
+        duration = self.input_frame_offsets[-1] if len(self.input_frame_offsets) > 0 else 0
+        stats["frames"] = self.replay_frames
+        stats["rate"] = (self.replay_frames - 1) / elapsed if elapsed > 0 else 0.0
+        stats["recorded_rate"] = (len(self.input_frame_offsets) - 1) / duration if duration > 0 else numpy.nan
+        stats["speed"] = (self.replay_frames + self.skipped_frames - 1) / elapsed / stats["recorded_rate"] if elapsed > 0 else numpy.nan
+        if self.replay_scheduler is not None:
+            lateness = self.replay_scheduler.stats()
+            stats["missed"] = lateness["missed"]
+            stats["skipped"] = lateness["skipped"]
+            stats["jitter_p50_ms"] = lateness["jitter_p50_ms"]
+            stats["jitter_p99_ms"] = lateness["jitter_p99_ms"]
+            stats["jitter_max_ms"] = lateness["jitter_max_ms"]
+        return stats
         
     def setOutputFile(self, source):
         self.output_dir = source
@@ -53,206 +275,597 @@ class Application:
         print(self.output_dir)
         self.output_file_template = self.output_dir + '/' + self.output_dir[self.output_dir.rfind('/')+1 :]
         print(self.output_file_template)
-        self.output_file_csv = open(self.output_file_template+".csv", mode="w")
-        self.output_writer = csv.writer(self.output_file_csv)
-        head = ["x1", "y1", "x2", "y2", "x3", "y3", "mid", "angle","orig_path", "marked_path"]
-        self.output_writer.writerow(head)
-        
+        if self.recording_format == "container":
+            self.output_container = container.ContainerWriter(self.output_file_template)
+            self.output_encode = self.output_container.encode
+            self.output_commit = self.output_container.commit
+        else:
+            self.output_file_csv = open(self.output_file_template+".csv", mode="w")
+            self.output_writer = csv.writer(self.output_file_csv)
+            self.output_writer.writerow(container.recordingHead(len(self.actuators)))
+            self.output_encode = lambda name, frame: cv2.imwrite(name, frame)
+            self.output_commit = lambda row, results: self.output_writer.writerow(row)
+        self.recorded_calibration = None
+        if self.async_recording:
+            self.recorder = AsyncRecorder(self.output_encode, self.output_commit,
+                self.recording_workers, self.recording_queue_size, self.recording_policy)
+
+    def trackingStats(self):
+        if self.backend is None or self.backend.roi_tracker is None:
+            return None
+        return self.backend.roi_tracker.stats()
+
+    def predictionStats(self):
+        if self.predictors is None:
+            return None
+        stats = [predictor.stats() for predictor in self.predictors]
+        measured = stats[0]["measured"]
+        predicted = stats[0]["predicted"]
+        return {
+            "measured": measured,
+            "predicted": predicted,
+            "predicted_ratio": predicted / max(measured + predicted, 1),
+            "uncertainty": max(s["uncertainty"] for s in stats),
+        }
+
+    def pacingStats(self):
+        if self.scheduler is None:
+            return None
+        stats = self.scheduler.stats()
+        stats["skipped_frames"] = self.skipped_frames
+        return stats
+
+    def recordingStats(self):
+        if self.recorder is None:
+            return None
+        return self.recorder.stats()
+
     def close(self):
-        cv2.destroyWindow(self.name)
+        if self.window:
+            cv2.destroyWindow(self.name)
         if self.input_source == Application.INPUT_TYPE.Camera:
+            stats = self.captureStats()
+            if stats is not None:
+                print(f"Captured {stats['captured']}, processed {stats['consumed']}, dropped {stats['dropped']}, max queue depth {stats['max_queue_depth']}")
             self.video_capture.release()
-        if self.input_source == Application.INPUT_TYPE.CSV:
-            self.input_file_csv.close()
-        if self.output_mode:
+        stats = self.trackingStats()
+        if stats is not None:
+            print(f"ROI hits {stats['roi_hits']}, full-frame detections {stats['full_frame']}, fallbacks {stats['fallbacks']}")
+        if self.input_prefetcher is not None:
+            self.input_prefetcher.close()
+            stats = self.replayStats()
+            print(f"Replay cache hits {stats['cache_hits']}, prefetched {stats['prefetch_hits']}, loaded {stats['direct_loads']}, cache size {stats['cache_mb']:.0f} MB")
+            print(f"Replayed {stats['frames']} frames at {stats['rate']:.2f} fps, recorded at {stats['recorded_rate']:.2f} fps, speed {stats['speed']:.2f}x")
+            if self.replay_scheduler is not None:
+                print(f"Missed {stats['missed']} recorded frame times, skipped {stats['skipped']} frames, "
+                      f"lateness {stats['jitter_p50_ms']:.2f}/{stats['jitter_p99_ms']:.2f}/{stats['jitter_max_ms']:.2f} ms p50/p99/max")
+            self.input_recording.close()
+        stats = self.pacingStats()
+        if stats is not None:
+            print(f"Paced {stats['iterations']} frames at {stats['rate']:.2f} fps (target {stats['target_rate']:.2f}), missed {stats['missed']} deadlines, skipped {stats['skipped']}, "
+                  f"jitter {stats['jitter_p50_ms']:.2f}/{stats['jitter_p99_ms']:.2f}/{stats['jitter_max_ms']:.2f} ms p50/p99/max")
+        if self.publisher is not None:
+            stats = self.publisher.stats()
+            print(f"Published {stats['sent']} messages, dropped {stats['dropped']}")
+            self.publisher.close()
+        if self.predictors is not None:
+            stats = self.predictionStats()
+            print(f"Measured {stats['measured']} frames, predicted {stats['predicted']} ({100*stats['predicted_ratio']:.0f}%)")
+        if self.recorder is not None:
+            self.recorder.close()
+            stats = self.recorder.stats()
+            print(f"Recorded {stats['written']} frames, dropped {stats['dropped']}, max queue depth {stats['max_queue_depth']}, encode time {stats['encode_ms_mean']:.1f} ms mean / {stats['encode_ms_max']:.1f} ms max")
+        self.profiler.close()
+        if self.output_file_csv is not None:
             self.output_file_csv.close()
+        if self.output_container is not None:
+            self.output_container.close()
 
     def run(self):
-        self.__getFrame()
+        # With pacing_rate set, the frame is obtained when it is due, and the
+        # recorded frames of skipped deadlines are left out. The replay modes
+        # of recordings take precedence over pacing_rate.
+        replay_mode = self.replay_mode if self.input_recording is not None else None
+        if replay_mode == "step" and self.window and not self.step_requested:
+            self.__keyboardResponse()
+            return
+        if replay_mode == "realtime":
+            self.__replayWait()
+        elif replay_mode is None and self.pacing_rate > 0:
+            if self.scheduler is None:
+                self.scheduler = PacingScheduler(self.pacing_rate, self.pacing_policy)
+            skipped = self.scheduler.wait()
+            if skipped > 0:
+                self.__skipFrames(skipped)
+        self.profiler.beginFrame()
+        with self.profiler.stage("getFrame"):
+            self.__getFrame()
         if self.success:
+            self.frame_number += 1
             self.__findAngle()
+            self.__publish()
             self.__drawWindow()
+            self.step_requested = False
         self.__keyboardResponse()
+        self.profiler.endFrame()
+
+    # Runs the detection on a single frame without window, input or output.
+    # Returns the angle of the first actuator, or -1 if its markers were not found.
+    def processFrame(self, frame):
+        self.frame = frame
+        self.__findAngle()
+        return self.angle if len(self.markers) == 3 else -1
 
     def __getFrame(self):
         if self.input_source == Application.INPUT_TYPE.Camera:
             self.success, self.frame = self.video_capture.read()
-        if self.input_source == Application.INPUT_TYPE.CSV:
-            try:
-                data = next(self.input_reader)
-                while data == ["# c pressed"]:
-                    if not self.calibrated:
-                        self.__perspectiveCalibration()
-                    else:
-                        self.calibrated = False
-                    data = next(self.input_reader)
-
-                if len(data) == 10 and os.path.isfile(data[8]):
-                    self.frame = cv2.imread(data[8])
-                    self.success = 1
-                else:
-                    self.success = 0
-                    self.__getFrame()
-
-            except StopIteration:
-                if self.loop:
-                    self.setInputFile(self.input_file_path)
+            if self.threaded_capture:
+                self.frame_timestamp = self.video_capture.timestamp
+            else:
+                self.frame_timestamp = time.clock_gettime(time.CLOCK_REALTIME)
+        if self.input_source in (Application.INPUT_TYPE.CSV, Application.INPUT_TYPE.Container):
+            self.success = 0
+            missing = 0
+            while missing <= len(self.input_frame_positions):
+                if self.input_position >= len(self.input_events):
+                    if not self.loop or len(self.input_frame_positions) == 0:
+                        return
+                    self.input_position = 0
                     self.calibrated = False
-                    self.__getFrame()
+                    self.__resetPredictors()
+                kind, value = self.input_events[self.input_position]
+                self.input_position += 1
+                if kind == "calibration":
+                    self.__setCalibration(value)
+                elif kind == "toggle":
+                    self.__replayCalibrationToggle(value)
                 else:
-                    self.success = 0
-                
-    def __storeFrame(self, id, prefix):
+                    frame = self.input_prefetcher.get(value, self.__upcomingFrames())
+                    if frame is not None:
+                        self.frame = frame
+                        self.frame_timestamp = time.clock_gettime(time.CLOCK_REALTIME)
+                        self.success = 1
+                        self.replay_frames += 1
+                        if self.replay_start is None:
+                            self.replay_start = time.monotonic()
+                        return
+                    missing += 1
+
+    def __skipFrames(self, count):
+        # Live frames which were not read are gone anyway. In a recording, the
+        # calibration events between and after the skipped frames are still
+        # applied, and a C press calibrates from the frame before it as usual.
+        if self.input_source not in (Application.INPUT_TYPE.CSV, Application.INPUT_TYPE.Container):
+            return
+        skipped = None
+        while self.input_position < len(self.input_events):
+            kind, value = self.input_events[self.input_position]
+            if kind == "frame" and count == 0:
+                break
+            if kind == "calibration":
+                self.__setCalibration(value)
+            elif kind == "toggle":
+                if skipped is not None:
+                    frame = self.input_prefetcher.get(skipped, self.__upcomingFrames())
+                    if frame is not None:
+                        self.frame = frame
+                    skipped = None
+                self.__replayCalibrationToggle(value)
+            else:
+                skipped = value
+                count -= 1
+                self.skipped_frames += 1
+            self.input_position += 1
+
+    def __replayWait(self):
+        # The next frame is obtained at its recorded time, relative to the first
+        # frame after the start, a seek or a loop. With the skip policy, the
+        # frames which are followed by another frame that is already due are
+        # left out.
+        if self.replay_scheduler is None:
+            self.replay_scheduler = PacingScheduler(policy=self.pacing_policy)
+        positions = self.input_frame_positions
+        index = bisect.bisect_left(positions, self.input_position)
+        if index >= len(positions):
+            if not self.loop or len(positions) == 0:
+                return
+            self.replay_scheduler.restart()
+            index = 0
+        if self.pacing_policy == "skip":
+            skipped = 0
+            while index + 1 < len(positions) and self.replay_scheduler.due(self.input_frame_offsets[index+1] / self.replay_speed):
+                index += 1
+                skipped += 1
+            if skipped > 0:
+                self.replay_scheduler.skip(skipped)
+                self.__skipFrames(skipped)
+        self.replay_scheduler.waitUntil(self.input_frame_offsets[index] / self.replay_speed)
+
+    def __upcomingFrames(self):
+        # The frames after the current position, continuing from the start
+        # when the recording is looped
+        positions = self.input_frame_positions
+        start = bisect.bisect_left(positions, self.input_position)
+        upcoming = positions[start : start+self.prefetch_depth]
+        if self.loop:
+            upcoming += positions[: min(self.prefetch_depth-len(upcoming), start)]
+        return [self.input_events[p][1] for p in upcoming]
+
+    def __storeFrame(self, id, prefix, image):
         name = f"{self.output_file_template}_{prefix}_{id}.png"
-        cv2.imwrite(name, self.frame)
+        if self.recorder is not None:
+            self.frame_queue.append((name, image.copy()))
+        else:
+            self.frame_queue.append(self.output_encode(name, image))
         self.csv_queue.append(name)
 
     def __storeCSV(self):
-        if len(self.markers) != 3:
-            data = [-1, -1, -1, -1, -1, -1, 3] + [self.angle] + self.csv_queue
+        # The active calibration is written before the first frame and
+        # whenever it changes, so replay never has to detect it again
+        state = self.perspectiveMatrix.tobytes() if self.calibrated else b""
+        if state != self.recorded_calibration:
+            self.__storeComment(calibration.calibrationRow(self.perspectiveMatrix if self.calibrated else None))
+            self.recorded_calibration = state
+        columns = [container.actuatorColumns(markers, angle) for markers, angle in zip(self.actuator_markers, self.actuator_angles)]
+        data = columns[0] + self.csv_queue + [int(self.measured)]
+        for group in columns[1:]:
+            data += group
+        if self.recorder is not None:
+            self.recorder.submit(data, self.frame_queue)
         else:
-            data = [number for point in self.markers for number in point] + [3] + [self.angle] + self.csv_queue
-        self.output_writer.writerow(data)
+            self.output_commit(data, self.frame_queue)
         self.csv_queue.clear()
+        self.frame_queue = []
+
+    def __storeComment(self, row):
+        if self.recorder is not None:
+            self.recorder.writeRow(row)
+        else:
+            self.output_commit(row, [])
         
-    dictionary = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_4X4_50)
-    parameters =  cv2.aruco.DetectorParameters()
-    detector = cv2.aruco.ArucoDetector(dictionary, parameters)
-    
+    def __arucoDetector(self):
+        # Built on first use, so importing the module is cheap
+        if self.detector is None:
+            self.detector = aruco_core.createDetector()
+        return self.detector
+
     def __perspectiveCalibration(self):
-        markerCorners, markerIds, _ = Application.detector.detectMarkers(self.frame)
-        markers = []
-        for i in range(len(markerCorners)):
-            if markerIds[i][0] == 42:
-                center = sum(markerCorners[i][0])/4
-                markers.append(center)
-
-        if len(markers) != 4:
-            print(f"{len(markers)} out of 4 calibration markers found")
+        matrix = aruco_core.calibrationMatrix(self.__arucoDetector(), self.frame)
+        if matrix is None:
             return -1
-        center_of_centers = sum(markers)/4
-        def clockwiseKey(x):
-            v = numpy.add(x, -center_of_centers)
-            angle = numpy.arccos(v[0]/numpy.dot(v, v))
-            if v[1] < 0: angle *= -1
-            return angle
-            
-        markers.sort(key = clockwiseKey)
-        markers = numpy.float32(markers)
-
-        PADDING = 50
-        boundaries = numpy.float32([
-            [PADDING, PADDING],
-            [self.frame.shape[1]-PADDING, PADDING],
-            [self.frame.shape[1]-PADDING, self.frame.shape[1]-PADDING],
-            [PADDING, self.frame.shape[1]-PADDING],
-        ])
-
-        self.perspectiveMatrix = cv2.getPerspectiveTransform(markers, boundaries)
+        self.perspectiveMatrix = matrix
         self.calibrated = True
 
+    def __createBackend(self, name):
+        if name == "aruco":
+            # Coarse-to-fine detection with sub-pixel corners when pyramid_scale is set
+            return detectors.ArucoBackend(self.actuators, self.__arucoDetector(), self.pyramid_scale,
+                                          self.roi_tracking, self.roi_padding, self.roi_fallback)
+        if name == "points":
+            backend = detectors.PointsBackend()
+        elif name == "perspective":
+            backend = detectors.PerspectiveBackend()
+        else:
+            raise ValueError(f"Unknown detector backend '{name}', expected one of {detectors.BACKENDS} or 'auto'")
+        if len(self.actuators) > backend.actuators:
+            raise ValueError(f"The {name} detector finds only {backend.actuators} actuator")
+        return backend
+
+    def __detectMarkers(self):
+        # With detector_backend "auto", the first probe_frames frames are
+        # measured with ArUco and kept. Every backend which can find all
+        # actuators is then timed on them, and the fastest one whose angles
+        # agree with ArUco is used.
+        if self.probe_queue is not None:
+            self.probe_queue.append(self.frame)
+            if len(self.probe_queue) >= self.probe_frames:
+                self.__probeBackends()
+        return self.backend.detect(self.frame)
+
+    def __probeBackends(self):
+        backends = [self.backend]
+        for name in detectors.BACKENDS[1:]:
+            try:
+                backends.append(self.__createBackend(name))
+            except ValueError:
+                pass
+        self.probe_results = detectors.probeBackends(backends, self.probe_queue, self.probe_tolerance)
+        self.probe_queue = None
+        for result in self.probe_results:
+            print(f"Detector {result['name']}: {result['ms']:.1f} ms per frame, all points found in {100*result['found']:.0f}% "
+                  f"and the angles agreed in {100*result['agreed']:.0f}% of the frames")
+        backend = detectors.selectBackend(self.probe_results, self.probe_min_found)
+        if backend is None:
+            print(f"No detector found all points reliably, using {self.backend.name}")
+            return
+        if backend is not self.backend:
+            self.backend = backend
+            self.__resetPredictors()
+        print(f"Using the {backend.name} detector")
+
     def __findAngle(self):
+        # One detection pass gives the markers of every actuator. With motion
+        # prediction, the detection runs only every few frames or when the
+        # predicted marker positions become too uncertain
+        if self.backend is None:
+            automatic = self.detector_backend == "auto"
+            self.backend = self.__createBackend("aruco" if automatic else self.detector_backend)
+            self.probe_queue = [] if automatic else None
+        if len(self.actuator_angles) != len(self.actuators):
+            self.actuator_markers = [[] for _ in self.actuators]
+            self.actuator_raw_markers = [[] for _ in self.actuators]
+            self.actuator_angles = [0 for _ in self.actuators]
+            self.predictors = None
+        self.measured = True
+        if self.motion_prediction and self.predictors is None:
+            self.predictors = [MarkerPredictor(self.prediction_interval, self.prediction_threshold) for _ in self.actuators]
+        if self.predictors is not None:
+            for predictor in self.predictors:
+                predictor.advance()
+            if not any(predictor.shouldMeasure() for predictor in self.predictors):
+                self.measured = False
+                for i, predictor in enumerate(self.predictors):
+                    self.__actuatorAngle(i, predictor.predict(self.backend.precise))
+                return
         try:
-            markerCorners, markerIds, _ = Application.detector.detectMarkers(self.frame)
-        except:
+            with self.profiler.stage("detectMarkers"):
+                groups = self.__detectMarkers()
+        except Exception:
             return
-        self.markers = [] # [id, coordinate] 
-        for i in range(len(markerCorners)):
-            if not (markerIds[i][0] == 8 or markerIds[i][0] == 9):
-                continue
-            center = sum(markerCorners[i][0])/4
-            center = [int(center[0]), int(center[1])]
-            if (markerIds[i][0] == 8):
-                self.markers.insert(0, center)
-            if (markerIds[i][0] == 9):
-                self.markers.append(center)
-
-        if len(self.markers) != 3: return -1
+        for i, markers in enumerate(groups):
+            if self.predictors is not None:
+                if len(markers) == 3:
+                    markers = self.predictors[i].update(markers)
+                else:
+                    self.predictors[i].reset()
+            self.__actuatorAngle(i, markers)
 
-        if self.calibrated:
-            for i in range(len(self.markers)):
-                point = cv2.perspectiveTransform(numpy.float32(self.markers[i]).reshape(-1, 1, 2), self.perspectiveMatrix)
-                point = [int(p) for p in point[0][0]]
-                self.markers[i] = point
-        
-        vector = []
-        vector.append(numpy.subtract(self.markers[2], self.markers[0]))
-        vector.append(numpy.subtract(self.markers[2], self.markers[1]))
-        vector.append(numpy.subtract(self.markers[0], self.markers[1]))
-        mag = [numpy.dot(v, v) for v in vector]
+    def __actuatorAngle(self, index, markers):
+        self.actuator_raw_markers[index] = markers
+        if len(markers) == 3:
+            with self.profiler.stage("perspectiveTransform"):
+                markers, self.actuator_angles[index] = self.backend.measure(markers, self.perspectiveMatrix if self.calibrated else None)
+        self.actuator_markers[index] = markers
+        if index == 0:
+            self.raw_markers = self.actuator_raw_markers[0]
+            self.markers = markers
+            self.angle = self.actuator_angles[0]
 
-        try:
-            self.angle = numpy.arccos((mag[0] + mag[1] - mag[2]) / (2*numpy.sqrt(mag[0]*mag[1])))
-            self.angle = int((self.angle * 180 / numpy.pi))
-        except:
-            self.angle = -1
+    def __publish(self):
+        # Sent before drawing and recording, so a subscriber gets the angles
+        # as soon as they are known
+        if self.publish_address is None:
+            return
+        if self.publisher is None:
+            self.publisher = AnglePublisher(self.publish_address)
+        for i, (markers, angle) in enumerate(zip(self.actuator_markers, self.actuator_angles)):
+            self.publisher.publish(i, self.measured, self.frame_number, self.frame_timestamp, angle, markers)
 
     def __drawWindow(self):
         window_id = str(time.clock_gettime(time.CLOCK_REALTIME)).replace('.', '').ljust(17, '0')
         if self.output_mode:
-            self.__storeFrame(window_id, 'orig')
+            with self.profiler.stage("recording"):
+                self.__storeFrame(window_id, 'orig', self.frame)
+
+        # The window is refreshed at most display_rate times per second, but
+        # the marked frame is rendered for every recorded frame
+        now = time.monotonic()
+        display_rate = self.display_rate
+        if self.input_recording is not None and self.replay_mode == "fast" and display_rate <= 0:
+            display_rate = Application.FAST_DISPLAY_RATE
+        if self.input_recording is not None and self.replay_mode == "step":
+            display_rate = 0
+        display = self.name is not None and (display_rate <= 0 or now - self.display_time >= 1/display_rate)
+        if not display and not self.output_mode:
+            return
+        canvas = self.__renderCanvas()
+        if display:
+            self.display_time = now
+            with self.profiler.stage("imshow"):
+                if not self.window:
+                    cv2.namedWindow(self.name)
+                    self.window = True
+                cv2.imshow(self.name, canvas)
 
-        if self.calibrated:
-            self.frame = cv2.warpPerspective(self.frame, self.perspectiveMatrix, (self.frame.shape[1], self.frame.shape[1]))
-        if len(self.markers) == 3:
-            cv2.line(self.frame, self.markers[2], self.markers[0], (0, 0, 0), 4)
-            cv2.line(self.frame, self.markers[2], self.markers[1], (0, 0, 0), 4)
-            cv2.circle(self.frame, self.markers[0], 5, (0, 0, 255), -1)
-            cv2.circle(self.frame, self.markers[1], 5, (0, 0, 255), -1)
-            cv2.circle(self.frame, self.markers[2], 5, (255, 0, 0), -1)
-
-        self.frame.resize((self.frame.shape[0]+50, self.frame.shape[1], self.frame.shape[2]))
-        
-        cv2.putText(self.frame,f"Angle: {self.angle}", 
-                    (10, self.frame.shape[0]-15), 
-                    cv2.FONT_HERSHEY_DUPLEX, 1, (255, 255, 255), 1, 2)
         if self.output_mode:
-            cv2.circle(self.frame, (self.frame.shape[1]-40, self.frame.shape[0]-25), 15, (0, 0, 255), -1)
-        else:
-            cv2.circle(self.frame, (self.frame.shape[1]-40, self.frame.shape[0]-25), 15, (0, 0, 100), -1)
-        cv2.imshow(self.name, self.frame)
+            with self.profiler.stage("recording"):
+                self.__storeFrame(window_id, 'marked', canvas)
+                self.__storeCSV()
+
+    def __renderCanvas(self):
+        # The frame and the status bar are drawn into a canvas which is only
+        # reallocated when the frame size changes
+        warp = self.calibrated and self.display_warp
+        width = self.frame.shape[1]
+        height = width if warp else self.frame.shape[0]
+        shape = (height + Application.STATUS_BAR_HEIGHT, width, self.frame.shape[2])
+        if self.canvas is None or self.canvas.shape != shape:
+            self.canvas = numpy.zeros(shape, dtype=self.frame.dtype)
+        view = self.canvas[:height]
+        with self.profiler.stage("warp"):
+            if warp:
+                cv2.warpPerspective(self.frame, self.perspectiveMatrix, (width, height), dst=view)
+            else:
+                numpy.copyto(view, self.frame)
+        with self.profiler.stage("draw"):
+            self.__drawOverlay(height, warp)
+        return self.canvas
+
+    def __drawOverlay(self, height, warp):
+        self.canvas[height:] = 0
+
+        for markers in (self.actuator_markers if warp else self.actuator_raw_markers):
+            if len(markers) != 3:
+                continue
+            markers = [[int(x), int(y)] for x, y in markers]
+            cv2.line(self.canvas, markers[2], markers[0], (0, 0, 0), 4)
+            cv2.line(self.canvas, markers[2], markers[1], (0, 0, 0), 4)
+            cv2.circle(self.canvas, markers[0], 5, (0, 0, 255), -1)
+            cv2.circle(self.canvas, markers[1], 5, (0, 0, 255), -1)
+            cv2.circle(self.canvas, markers[2], 5, (255, 0, 0), -1)
 
+        if len(self.actuator_angles) > 1:
+            text = "Angles: " + ", ".join(str(angle) for angle in self.actuator_angles)
+        else:
+            text = f"Angle: {self.angle}"
+        cv2.putText(self.canvas, text, 
+                    (10, self.canvas.shape[0]-15), 
+                    cv2.FONT_HERSHEY_DUPLEX, 1, (255, 255, 255), 1, 2)
+        stats = self.captureStats()
+        if stats is not None:
+            cv2.putText(self.canvas, f"Dropped: {stats['dropped']} Queue: {stats['queue_depth']}",
+                        (250, self.canvas.shape[0]-15),
+                        cv2.FONT_HERSHEY_DUPLEX, 1, (255, 255, 255), 1, 2)
         if self.output_mode:
-            self.__storeFrame(window_id, 'marked')
-            self.__storeCSV()
+            cv2.circle(self.canvas, (self.canvas.shape[1]-40, self.canvas.shape[0]-25), 15, (0, 0, 255), -1)
+        else:
+            cv2.circle(self.canvas, (self.canvas.shape[1]-40, self.canvas.shape[0]-25), 15, (0, 0, 100), -1)
 
     def __keyboardResponse(self):
-        k = cv2.pollKey()
+        if not self.window:
+            return
+        # Single-step replay waits for a key instead of spinning
+        if self.input_recording is not None and self.replay_mode == "step":
+            k = cv2.waitKey(Application.STEP_WAIT_MS)
+        else:
+            k = cv2.pollKey()
         if (k == 8): # backspace - close
-            app.success = False
+            self.success = False
+        if (k == 110 or k == 32): # n or space - next frame in single-step replay
+            self.step_requested = True
         if (k == 99): # c - calibrate
             if not self.calibrated:
                 self.__perspectiveCalibration()
             else:
                 self.calibrated = False
-            if self.output_mode:
-                self.output_writer.writerow(["# c pressed"])
+            if self.input_source == Application.INPUT_TYPE.Camera:
+                self.__saveCalibration(self.calibration_source)
         if (k == 114): # r - toggle record
             self.output_mode = not self.output_mode
-            
-parser = argparse.ArgumentParser()
-parser.add_argument("-c", "--camera", action='store', help = "Camera path")
-parser.add_argument("-i", "--input", action='store', help = "Input file path")
-parser.add_argument("-o", "--output", action='store', help = "Output file path")
-parser.add_argument("-d", "--delay", action='store', help = "Delay between frames")
-args = parser.parse_args()
-
-window_name = args.output
-if window_name == None:
-    window_name = args.input
-app = Application(f"ArUco markers - {window_name}")
-if args.camera != None:
+        if (k == 112): # p - toggle profiling
+            self.profiler.toggle()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--camera", action='store', help = "Camera path")
+    parser.add_argument("-i", "--input", action='store', help = "Input file path")
+    parser.add_argument("-o", "--output", action='store', help = "Output file path")
+    parser.add_argument("-d", "--delay", action='store', help = "Time between frames in seconds, the same as --rate 1/DELAY")
+    parser.add_argument("--rate", action='store', help = "Frames processed per second, paced with deadlines")
+    parser.add_argument("--pacing", action='store', choices = PacingScheduler.POLICIES, help = "Skip frames or run late when a frame takes longer than its period")
+    parser.add_argument("--replay", action='store', choices = Application.REPLAY_MODES, help = "Replay at the recorded times, as fast as possible, or one frame per key press")
+    parser.add_argument("--speed", action='store', help = "Speed factor of the realtime replay")
+    parser.add_argument("-t", "--threaded", action='store_true', help = "Capture camera frames on a background thread")
+    parser.add_argument("-q", "--queue-depth", action='store', help = "Number of frames kept by the threaded capture")
+    parser.add_argument("--calibration-cache", action='store', help = "File where perspective calibrations are stored")
+    parser.add_argument("--no-calibration-cache", action='store_true', help = "Do not load or store perspective calibrations")
+    parser.add_argument("-p", "--profile", action='store_true', help = "Time every processing stage from the start (toggled with P)")
+    parser.add_argument("--profile-output", action='store', help = "CSV file for the per-frame stage timings")
+    parser.add_argument("--profile-period", action='store', help = "Seconds between profiling summary lines")
+    parser.add_argument("--roi", action='store_true', help = "Search only around the previous marker positions")
+    parser.add_argument("--roi-padding", action='store', help = "Padding of the search regions in marker sizes")
+    parser.add_argument("--roi-fallback", action='store', choices = RoiTracker.POLICIES, help = "When to search the full frame after a marker is lost")
+    parser.add_argument("--actuators", action='store', help = "Comma separated TIP_ID/VERTEX_ID marker pairs, one per actuator")
+    parser.add_argument("--detector", action='store', choices = ["auto"] + detectors.BACKENDS, help = "Detection backend, auto times all of them on the first frames")
+    parser.add_argument("--probe-frames", action='store', help = "Number of frames the detectors are timed on with --detector auto")
+    parser.add_argument("--pyramid", action='store', help = "Detect the markers at this scale and refine the corners at full resolution")
+    parser.add_argument("--predict", action='store_true', help = "Predict the marker positions between detections")
+    parser.add_argument("--predict-interval", action='store', help = "Maximum number of predicted frames between detections")
+    parser.add_argument("--predict-threshold", action='store', help = "Prediction uncertainty in pixels which forces a detection")
+    parser.add_argument("--no-display", action='store_true', help = "Do not open a window, stop with Ctrl+C")
+    parser.add_argument("--record", action='store_true', help = "Start recording immediately, always the case with --output and --no-display")
+    parser.add_argument("--display-rate", action='store', help = "Maximum number of window refreshes per second")
+    parser.add_argument("--no-warp", action='store_true', help = "Do not apply the perspective transform to the displayed frame")
+    parser.add_argument("-f", "--format", action='store', choices = ["png", "container"], help = "Recording format")
+    parser.add_argument("-a", "--async-recording", action='store_true', help = "Encode and write recorded frames on a worker pool")
+    parser.add_argument("--recording-workers", action='store', help = "Number of recording worker threads")
+    parser.add_argument("--recording-queue", action='store', help = "Maximum number of frames waiting to be written")
+    parser.add_argument("--prefetch", action='store', help = "Number of recorded frames decoded ahead during replay")
+    parser.add_argument("--prefetch-workers", action='store', help = "Number of threads decoding recorded frames")
+    parser.add_argument("--cache-size", action='store', help = "Memory for decoded recorded frames in megabytes")
+    parser.add_argument("--publish", action='store', help = "Send the angles of every frame to udp://HOST:PORT or unix://PATH")
+    parser.add_argument("--recording-policy", action='store', choices = AsyncRecorder.POLICIES, help = "Block or drop frames when the recording queue is full")
+    args = parser.parse_args(argv)
+
+    window_name = args.output
+    if window_name == None:
+        window_name = args.input
+    app = Application(f"ArUco markers - {window_name}" if not args.no_display else None)
+    if args.calibration_cache != None:
+        app.calibration_cache_path = args.calibration_cache
+    if args.no_calibration_cache:
+        app.calibration_cache_path = None
+    app.threaded_capture = args.threaded
+    if args.queue_depth != None:
+        app.capture_queue_depth = int(args.queue_depth)
+    app.async_recording = args.async_recording
+    if args.format != None:
+        app.recording_format = args.format
+    app.roi_tracking = args.roi
+    if args.actuators != None:
+        app.actuators = aruco_core.parseActuators(args.actuators)
+    app.motion_prediction = args.predict
+    if args.detector != None:
+        app.detector_backend = args.detector
+    if args.probe_frames != None:
+        app.probe_frames = int(args.probe_frames)
+    if args.pyramid != None:
+        app.pyramid_scale = float(args.pyramid)
+    if args.predict_interval != None:
+        app.prediction_interval = int(args.predict_interval)
+    if args.predict_threshold != None:
+        app.prediction_threshold = float(args.predict_threshold)
+    app.profiler.output_path = args.profile_output
+    if args.profile_period != None:
+        app.profiler.period = float(args.profile_period)
+    app.profiler.setEnabled(args.profile)
+    if args.display_rate != None:
+        app.display_rate = float(args.display_rate)
+    app.display_warp = not args.no_warp
+    if args.roi_padding != None:
+        app.roi_padding = float(args.roi_padding)
+    if args.roi_fallback != None:
+        app.roi_fallback = args.roi_fallback
+    if args.recording_workers != None:
+        app.recording_workers = int(args.recording_workers)
+    if args.recording_queue != None:
+        app.recording_queue_size = int(args.recording_queue)
+    if args.recording_policy != None:
+        app.recording_policy = args.recording_policy
+    if args.prefetch != None:
+        app.prefetch_depth = int(args.prefetch)
+    if args.prefetch_workers != None:
+        app.prefetch_workers = int(args.prefetch_workers)
+    if args.cache_size != None:
+        app.frame_cache_size = float(args.cache_size)
+    if args.publish != None:
+        app.publish_address = args.publish
+    if args.camera != None:
+        try:
+            app.setCamera(int(args.camera))
+        except:
+            app.setCamera(args.camera)
+    if args.input != None:
+        app.setInputFile(args.input)
+    if args.output != None:
+        app.setOutputFile(args.output)
+        # without a window the R key cannot be pressed
+        app.output_mode = args.record or args.no_display
+    if args.rate != None:
+        app.pacing_rate = float(args.rate)
+    elif args.delay != None and float(args.delay) > 0:
+        app.pacing_rate = 1 / float(args.delay)
+    if args.pacing != None:
+        app.pacing_policy = args.pacing
+    app.replay_mode = args.replay
+    if args.speed != None:
+        app.replay_speed = float(args.speed)
     try:
-        app.setCamera(int(args.camera))
-    except:
-        app.setCamera(args.camera)
-if args.input != None:
-    app.setInputFile(args.input)
-if args.output != None:
-    app.setOutputFile(args.output)
-if args.delay == None:
-    args.delay = 0
-while app.success:
-    app.run()
-    time.sleep(float(args.delay))
-app.close()
+        while app.success:
+            app.run()
+    except KeyboardInterrupt:
+        pass
+    app.close()
+
+if __name__ == "__main__":
+    main()
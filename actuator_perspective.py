@@ -6,6 +6,7 @@ import random
 import csv
 import os
 from enum import Enum
+import assignment
 
 class Application(object):
     # constants
@@ -16,6 +17,10 @@ class Application(object):
         [-1, -1, -1]
     ])
     MARKER_THRESHOLD = 200
+    MAX_JUMP = 100 # pixels per frame
+    BOX_TOLERANCE = 1.0 # pixels
+    MATRIX_SMOOTHING = 0.5
+    MATRIX_EPSILON = 1e-4 # relative to the largest matrix entry
     MARKER_COLORS = [(0, 0, 255), (0, 170, 0), (255, 0, 0)]
     LINE_COLOR = (0, 0, 0)
     LINE_WIDTH = 2
@@ -28,9 +33,10 @@ class Application(object):
         CSV = 1          
 
     # public methods
-    def __init__(self, name):
+    def __init__(self, name=None):
         self.name = name
-        cv2.namedWindow(self.name)
+        if self.name is not None:
+            cv2.namedWindow(self.name)
         self.prev_points = [[0, 0], [0, 0], [0, 0]]
         self.mid_point = 0
         self.angle = 0
@@ -38,6 +44,11 @@ class Application(object):
         self.output_mode = False
         self.csv_queue = []
         self.prev_box = []
+        self.matrix_caching = False
+        self.display_warp = True
+        self.matrix = None
+        self.matrix_target = None
+        self.matrix_box = None
         
     def setCamera(self, source):
         self.input_source = Application.INPUT_TYPE.Camera
@@ -67,7 +78,8 @@ class Application(object):
         self.output_writer.writerow(head)
 
     def close(self):
-        cv2.destroyWindow(self.name)
+        if self.name is not None:
+            cv2.destroyWindow(self.name)
         if self.input_source == Application.INPUT_TYPE.Camera:
             self.video_capture.release()
         if self.input_source == Application.INPUT_TYPE.CSV:
@@ -80,8 +92,20 @@ class Application(object):
         self.points_success =  self.__findPoints()
         if self.points_success:
             self.__findAngle()
+            if self.display_warp:
+                self.__warpFrame()
         self.__drawWindow()
         return self.__keyboardResponse()
+
+    # Runs the detection on a single frame without window, input or output.
+    # Returns the angle, or -1 if the points were not found.
+    def processFrame(self, frame):
+        self.frame = frame
+        self.points_success = self.__findPoints()
+        if not self.points_success:
+            return -1
+        self.__findAngle()
+        return self.angle
     
     # private methods
     def __findPoints(self):
@@ -110,56 +134,25 @@ class Application(object):
                     y = int(m["m01"] / m["m00"]) 
                     points.append([x, y])
                     boxes.append(approx)
-                except:
+                except Exception:
                     return 0
             if self.calibrating_state and len(points) >= 3:
                break
         if len(points) < 3:
             return 0
 
-        # Point tracking
+        # Point tracking. When a point would have to jump further than
+        # MAX_JUMP, the tracking is lost and the points are acquired again
+        # from this frame, as after Enter.
         if not self.calibrating_state:
-            distance_f = lambda p1, p2: numpy.sqrt(numpy.dot(numpy.subtract(p1, p2), numpy.subtract(p1, p2)))
-            
-            costs = [[], [], []]
-            for i in range(3):
-                for j in range(len(points)):
-                    costs[i].append((j, distance_f(self.prev_points[i], points[j])))
-                costs[i].sort(key = lambda x: x[1])
-
-            solutions = []
-            for k0 in range(3):
-                for k1 in range(3):
-                    for k2 in range(3):
-                        if ((costs[0][k0][0] != costs[1][k1][0]) and
-                            (costs[1][k1][0] != costs[2][k2][0]) and
-                            (costs[2][k2][0] != costs[0][k0][0])):
-                           solutions.append((costs[0][k0][0], costs[1][k1][0], costs[2][k2][0]))
-
-            def cost_f(x):
-                result = 0
-                for i in range(3):
-                    j = 0
-                    while costs[i][j][0] != x[i]:
-                        j += 1
-                    result += costs[i][j][1]
-                return result
-                    
-            best_index = 0
-            best_cost = cost_f(solutions[best_index])
-            for i in range(len(solutions)):
-                current_cost = cost_f(solutions[i])
-                if current_cost < best_cost:
-                    best_index = i
-                    best_cost = current_cost
-
-            new_points = [[], [], []]
-            new_boxes = [[], [], []]
-            for i in range(3):
-                new_points[i] = points[solutions[best_index][i]]
-                new_boxes[i] = boxes[solutions[best_index][i]]
-            points = new_points
-            boxes = new_boxes
+            assigned = assignment.assignPoints(self.prev_points, points, Application.MAX_JUMP)
+            if min(assigned) < 0:
+                self.calibrating_state = True
+                points = points[:3]
+                boxes = boxes[:3]
+            else:
+                points = [points[j] for j in assigned]
+                boxes = [boxes[j] for j in assigned]
 
         if self.calibrating_state:
             min_y = 0
@@ -188,24 +181,33 @@ class Application(object):
         #     mat = cv2.getPerspectiveTransform(self.prev_box[i], boundaries)
         #     matrix = numpy.add(matrix, mat)
         # matrix = matrix / 3
-        matrix = cv2.getPerspectiveTransform(self.prev_box[self.mid_point], boundaries)
-        matrix[2][0:2] = [0, 0]
-        matrix[0][2] = self.frame.shape[1]/3
-        matrix[1][2] = self.frame.shape[0]/3
-
-        for i in range(len(points)):
-            # points[i].append(1)
-            points[i] = numpy.matmul(matrix, numpy.array(points[i]+[1]))
-            # print(points[i])
-            points[i] = points[i][0:2]
+        # With matrix_caching, the target matrix is only computed again when a
+        # corner of the vertex box moves more than BOX_TOLERANCE. The matrix in
+        # use is blended towards the target on every frame until they agree.
+        box = self.prev_box[self.mid_point]
+        if (not self.matrix_caching or self.matrix is None
+                or numpy.abs(box - self.matrix_box).max() > Application.BOX_TOLERANCE):
+            matrix = cv2.getPerspectiveTransform(box, boundaries)
+            matrix[2][0:2] = [0, 0]
+            matrix[0][2] = self.frame.shape[1]/3
+            matrix[1][2] = self.frame.shape[0]/3
+            self.matrix_target = matrix
+            self.matrix_box = box
+            if not self.matrix_caching or self.matrix is None:
+                self.matrix = matrix
+        if self.matrix is not self.matrix_target:
+            difference = self.matrix_target - self.matrix
+            if numpy.abs(difference).max() <= Application.MATRIX_EPSILON * numpy.abs(self.matrix_target).max():
+                self.matrix = self.matrix_target
+            else:
+                self.matrix = self.matrix + Application.MATRIX_SMOOTHING * difference
 
-        self.frame = cv2.warpPerspective(self.frame, matrix, (self.frame.shape[1], self.frame.shape[0]))        
-        for p in points:
-            p = [int(p[0]), int(p[1])]
-            # print(p)
-            cv2.circle(self.frame, p, 4, (0, 0, 255), -1)
+        # The last row of the matrix is [0, 0, w], and the points are used
+        # without dividing by w, so the first two rows are applied to all of
+        # them at once
+        points = list(cv2.transform(numpy.float64(points).reshape(-1, 1, 2), self.matrix[0:2]).reshape(-1, 2))
+        self.transformed_points = points.copy()
         mid = points[self.mid_point]
-        cv2.circle(self.frame, [int(mid[0]), int(mid[1])], 7, (0, 0, 255), -1)
         # Law of cosines
         del points[self.mid_point]
         vector = []
@@ -219,11 +221,19 @@ class Application(object):
         try:
             self.angle = numpy.arccos((mag[0] + mag[1] - mag[2]) / (2*numpy.sqrt(mag[0]*mag[1])))
             self.angle = int((self.angle * 180 / numpy.pi))
-        except:
+        except Exception:
             self.angle = -1
 
         # print("------------------------------------------------------------")
         
+    def __warpFrame(self):
+        self.frame = cv2.warpPerspective(self.frame, self.matrix, (self.frame.shape[1], self.frame.shape[0]))
+        for p in self.transformed_points:
+            p = [int(p[0]), int(p[1])]
+            cv2.circle(self.frame, p, 4, (0, 0, 255), -1)
+        mid = self.transformed_points[self.mid_point]
+        cv2.circle(self.frame, [int(mid[0]), int(mid[1])], 7, (0, 0, 255), -1)
+
     def __getFrame(self):
         if self.input_source == Application.INPUT_TYPE.Camera:
             self.success, self.frame = self.video_capture.read()
@@ -272,7 +282,7 @@ class Application(object):
     def __keyboardResponse(self):
         k = cv2.pollKey()
         if (k == 8): # backspace
-            app.success = False
+            self.success = False
         if (k == 13): # enter
             self.calibrating_state = True
             self.prev_points = [[0, 0], [0, 0], [0, 0]]
@@ -280,14 +290,16 @@ class Application(object):
         
 ################################################################################
 
+def main():
+    app = Application("Marker tracking")
+    # app.setCamera("/dev/video0")
+    app.output_mode = True
+    app.setOutputFile("./recordings/test91")
+    app.setInputFile("./recordings/test90")
+    while app.success:
+        app.run()
+        time.sleep(0.1)
+    app.close()
 
-app = Application("Marker tracking")
-# app.setCamera("/dev/video0")
-app.output_mode = True
-app.setOutputFile("./recordings/test91")
-app.setInputFile("./recordings/test90")
-while app.success:
-    app.run()
-    time.sleep(0.1)
-app.close()
-    
+if __name__ == "__main__":
+    main()
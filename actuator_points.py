@@ -7,6 +7,7 @@ import random
 import csv
 import os
 from enum import Enum
+import assignment
 
 class Application(object):
     # constants
@@ -17,6 +18,11 @@ class Application(object):
         [-1, -1, -1]
     ])
     MARKER_THRESHOLD = 200
+    MAX_JUMP = 100 # pixels per frame
+    MIN_CONTOUR_AREA = 4
+    MAX_CONTOUR_AREA = 0.05 # fraction of the frame
+    MIN_CONTOUR_FILL = 0.2 # fraction of the bounding rectangle
+    MAX_CONTOUR_ASPECT = 5
     MARKER_COLORS = [(0, 0, 255), (0, 170, 0), (255, 0, 0)]
     LINE_COLOR = (0, 0, 0)
     LINE_WIDTH = 2
@@ -28,15 +34,17 @@ class Application(object):
         CSV = 1          
 
     # public methods
-    def __init__(self, name):
+    def __init__(self, name=None):
         self.name = name
-        cv2.namedWindow(self.name)
+        if self.name is not None:
+            cv2.namedWindow(self.name)
         self.prev_points = [(0, 0), (0, 0), (0, 0)]
         self.mid_point = 0
         self.angle = 0
         self.calibrating_state = True
         self.output_mode = False
         self.csv_queue = []
+        self.mask = None
         
     def setCamera(self, source):
         self.input_source = Application.INPUT_TYPE.Camera
@@ -66,7 +74,8 @@ class Application(object):
         self.output_writer.writerow(head)
                 
     def close(self):
-        cv2.destroyWindow(self.name)
+        if self.name is not None:
+            cv2.destroyWindow(self.name)
         if self.input_source == Application.INPUT_TYPE.Camera:
             self.video_capture.release()
         if self.input_source == Application.INPUT_TYPE.CSV:
@@ -81,6 +90,16 @@ class Application(object):
             self.__findAngle()
         self.__drawWindow()
         return self.__keyboardResponse()
+
+    # Runs the detection on a single frame without window, input or output.
+    # Returns the angle, or -1 if the points were not found.
+    def processFrame(self, frame):
+        self.frame = frame
+        self.points_success = self.__findPoints()
+        if not self.points_success:
+            return -1
+        self.__findAngle()
+        return self.angle
     
     # private methods
     def __findPoints(self):
@@ -91,23 +110,22 @@ class Application(object):
         thresh = cv2.threshold(frame_copy, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)[1]
         contours = cv2.findContours(thresh, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)[0]
 
-        contours = sorted(contours, key = lambda x: cv2.arcLength(x, True), reverse=True)
         points = []
-        frame_copy = cv2.cvtColor(frame_copy, cv2.COLOR_GRAY2BGR)
-
-        for c in contours:
-            epsilon = 0.01 * cv2.arcLength(c, True)
-            approx = cv2.approxPolyDP(c, epsilon, True)
-            mask = numpy.zeros_like(frame_copy[:, :, 0])
-            cv2.drawContours(mask, [approx], -1, 255, -1)
-            mean = cv2.mean(frame_copy, mask=mask)
+        for approx in self.__candidates(contours, frame_copy.shape):
+            # the brightness is measured inside the bounding rectangle only,
+            # with a mask buffer which is reused for every contour and frame
+            x, y, w, h = cv2.boundingRect(approx)
+            mask = self.mask[:h, :w]
+            mask[:] = 0
+            cv2.drawContours(mask, [approx], -1, 255, -1, offset=(-x, -y))
+            mean = cv2.mean(frame_copy[y:y+h, x:x+w], mask=mask)
             if (mean[0] > Application.MARKER_THRESHOLD):
                 m = cv2.moments(approx)
                 try:
                     x = int(m["m10"] / m["m00"]) 
                     y = int(m["m01"] / m["m00"]) 
                     points.append((x, y))
-                except:
+                except Exception:
                     return 0
             if self.calibrating_state and len(points) >= 3:
                break
@@ -115,46 +133,16 @@ class Application(object):
         if len(points) < 3:
             return 0
 
-        # Point tracking
+        # Point tracking. When a point would have to jump further than
+        # MAX_JUMP, the tracking is lost and the points are acquired again
+        # from this frame, as after Enter.
         if not self.calibrating_state:
-            distance_f = lambda p1, p2: numpy.sqrt(numpy.dot(numpy.subtract(p1, p2), numpy.subtract(p1, p2)))
-            
-            costs = [[], [], []]
-            for i in range(3):
-                for j in range(len(points)):
-                    costs[i].append((j, distance_f(self.prev_points[i], points[j])))
-                costs[i].sort(key = lambda x: x[1])
-
-            solutions = []
-            for k0 in range(3):
-                for k1 in range(3):
-                    for k2 in range(3):
-                        if ((costs[0][k0][0] != costs[1][k1][0]) and
-                            (costs[1][k1][0] != costs[2][k2][0]) and
-                            (costs[2][k2][0] != costs[0][k0][0])):
-                           solutions.append((costs[0][k0][0], costs[1][k1][0], costs[2][k2][0]))
-
-            def cost_f(x):
-                result = 0
-                for i in range(3):
-                    j = 0
-                    while costs[i][j][0] != x[i]:
-                        j += 1
-                    result += costs[i][j][1]
-                return result
-                    
-            best_index = 0
-            best_cost = cost_f(solutions[best_index])
-            for i in range(len(solutions)):
-                current_cost = cost_f(solutions[i])
-                if current_cost < best_cost:
-                    best_index = i
-                    best_cost = current_cost
-
-            new_points = [[], [], []]
-            for i in range(3):
-                new_points[i] = points[solutions[best_index][i]]
-            points = new_points
+            assigned = assignment.assignPoints(self.prev_points, points, Application.MAX_JUMP)
+            if min(assigned) < 0:
+                self.calibrating_state = True
+                points = points[:3]
+            else:
+                points = [points[j] for j in assigned]
 
         if self.calibrating_state:
             min_y = 0
@@ -167,6 +155,26 @@ class Application(object):
         self.prev_points = points
         return 1
     
+    def __candidates(self, contours, shape):
+        # Contours which are too small, too large, too thin or too sparse to
+        # be a marker spot are dropped before the approximation and scoring.
+        # The rest are ordered by their perimeter, longest first.
+        if self.mask is None or self.mask.shape != shape:
+            self.mask = numpy.zeros(shape, dtype=numpy.uint8)
+        max_area = Application.MAX_CONTOUR_AREA * shape[0] * shape[1]
+        candidates = []
+        for c in contours:
+            area = cv2.contourArea(c)
+            if area < Application.MIN_CONTOUR_AREA or area > max_area:
+                continue
+            _, _, w, h = cv2.boundingRect(c)
+            if area < Application.MIN_CONTOUR_FILL * w * h or max(w, h) > Application.MAX_CONTOUR_ASPECT * min(w, h):
+                continue
+            candidates.append((cv2.arcLength(c, True), c))
+        candidates.sort(key = lambda x: x[0], reverse=True)
+        for perimeter, c in candidates:
+            yield cv2.approxPolyDP(c, 0.01 * perimeter, True)
+
     def __findAngle(self):
         points = self.prev_points.copy()
         mid = self.prev_points[self.mid_point]
@@ -181,7 +189,7 @@ class Application(object):
         try:
             self.angle = numpy.arccos((mag[0] + mag[1] - mag[2]) / (2*numpy.sqrt(mag[0]*mag[1])))
             self.angle = int((self.angle * 180 / numpy.pi))
-        except:
+        except Exception:
             self.angle = -1
 
     def __getFrame(self):
@@ -226,7 +234,7 @@ class Application(object):
     def __keyboardResponse(self):
         k = cv2.pollKey()
         if (k == 8): # backspace
-            app.success = False
+            self.success = False
         if (k == 13): # enter
             self.calibrating_state = True
             self.prev_points = [(0, 0), (0, 0), (0, 0)]
@@ -234,13 +242,16 @@ class Application(object):
         
 ################################################################################
 
-app = Application("Marker tracking")
-app.setCamera("/dev/video2")
-app.output_mode = False
-# app.setOutputFile("./recordings/test91")
-# app.setInputFile("./recordings/test90")
-while app.success:
-    app.run()
-#    time.sleep(0.1)
-app.close()
-    
+def main():
+    app = Application("Marker tracking")
+    app.setCamera("/dev/video2")
+    app.output_mode = False
+    # app.setOutputFile("./recordings/test91")
+    # app.setInputFile("./recordings/test90")
+    while app.success:
+        app.run()
+    #    time.sleep(0.1)
+    app.close()
+
+if __name__ == "__main__":
+    main()
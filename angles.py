@@ -0,0 +1,79 @@
+import cv2
+import numpy
+import argparse
+import time
+import container
+import replay
+
+# Recomputes the angles of a recording from the stored points only, without
+# touching the images. All points are transformed with one
+# cv2.perspectiveTransform() call and the law of cosines is evaluated on whole
+# arrays. Rows without all three points get NaN.
+
+def loadPoints(path):
+    # Returns points as a float array of shape (frames, 3, 2) and the 0-based
+    # vertex index of every frame
+    recording = replay.Recording(path)
+    if recording.is_container:
+        records = container.ContainerReader(recording.template).records
+        records = records[records["kind"] == container.KIND_FRAME]
+        points = records["points"].astype(numpy.float64)
+        vertex = (records["vertex"] & container.VERTEX_MASK).astype(int) - 1
+    else:
+        # comment rows such as '# c pressed' are skipped by loadtxt()
+        table = numpy.loadtxt(recording.template+".csv", delimiter=",", skiprows=1,
+                              usecols=range(7), comments="#", ndmin=2)
+        points = table[:, 0:6]
+        vertex = table[:, 6].astype(int) - 1
+    points = points.reshape(-1, 3, 2)
+    invalid = numpy.all(points.reshape(-1, 6) == -1, axis=1)
+    points[invalid] = numpy.nan
+    return points, vertex
+
+def transformPoints(points, matrix):
+    if len(points) == 0:
+        return points.copy()
+    result = cv2.perspectiveTransform(points.reshape(-1, 1, 2), numpy.asarray(matrix, dtype=numpy.float64))
+    return result.reshape(points.shape)
+
+def computeAngles(points, vertex):
+    vertex = numpy.broadcast_to(numpy.asarray(vertex, dtype=int), (len(points),)) % 3
+    rows = numpy.arange(len(points))
+    mid = points[rows, vertex]
+    first = points[rows, (vertex+1) % 3]
+    second = points[rows, (vertex+2) % 3]
+    mag = [
+        numpy.sum((mid - first)**2, axis=1),
+        numpy.sum((mid - second)**2, axis=1),
+        numpy.sum((first - second)**2, axis=1),
+    ]
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        cosine = (mag[0] + mag[1] - mag[2]) / (2*numpy.sqrt(mag[0]*mag[1]))
+    cosine[~numpy.isfinite(cosine)] = numpy.nan
+    return numpy.degrees(numpy.arccos(numpy.clip(cosine, -1, 1)))
+
+def recomputeAngles(path, matrix=None, vertex=None):
+    points, recorded_vertex = loadPoints(path)
+    if matrix is not None:
+        points = transformPoints(points, matrix)
+    return points, computeAngles(points, recorded_vertex if vertex is None else vertex)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Recompute the angles of a recording from its stored points")
+    parser.add_argument("input", help = "Recording directory")
+    parser.add_argument("-o", "--output", action='store', help = "Output CSV file")
+    parser.add_argument("-m", "--matrix", action='store', help = "Text file with a 3x3 perspective matrix applied to the points")
+    parser.add_argument("-v", "--vertex", action='store', help = "Index (1-3) of the point where the angle is measured, the recorded one by default")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    matrix = numpy.loadtxt(args.matrix).reshape(3, 3) if args.matrix != None else None
+    vertex = int(args.vertex) - 1 if args.vertex != None else None
+    points, angles = recomputeAngles(args.input, matrix, vertex)
+    elapsed = time.perf_counter() - start
+    if args.output != None:
+        table = numpy.column_stack([numpy.arange(len(angles)), points.reshape(-1, 6), angles])
+        numpy.savetxt(args.output, table, delimiter=",", fmt=["%d"] + ["%.3f"]*7,
+                      header="frame,x1,y1,x2,y2,x3,y3,angle", comments="")
+    valid = numpy.count_nonzero(~numpy.isnan(angles))
+    print(f"Computed {len(angles)} angles ({valid} valid) in {elapsed*1000:.1f} ms")
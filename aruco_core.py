@@ -0,0 +1,162 @@
+import cv2
+import numpy
+import math
+
+# Detection and angle math of actuator_aruco.py without any window, camera or
+# file handling, so it can be used by headless tools and worker processes.
+TIP_ID = 8
+VERTEX_ID = 9
+CALIBRATION_ID = 42
+CALIBRATION_PADDING = 50
+
+def createDetector():
+    dictionary = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_4X4_50)
+    parameters =  cv2.aruco.DetectorParameters()
+    return cv2.aruco.ArucoDetector(dictionary, parameters)
+
+class PyramidDetector:
+    # Detects the markers on a downscaled frame, maps the corners back to full
+    # resolution and refines them with cv2.cornerSubPix() in small windows
+    # around them. A scale of 1 only adds the sub-pixel refinement. Has the
+    # same detectMarkers() interface as cv2.aruco.ArucoDetector.
+    CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 0.01)
+
+    def __init__(self, detector, scale=0.5, window=None):
+        self.detector = detector
+        self.scale = scale
+        # half size of the search window, covering the error of the mapping
+        self.window = window if window is not None else max(3, int(math.ceil(1.5/scale)))
+
+    def detectMarkers(self, frame):
+        small = frame
+        if self.scale != 1:
+            small = cv2.resize(frame, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        markerCorners, markerIds, rejected = self.detector.detectMarkers(small)
+        rejected = tuple(self.__fullResolution(r) for r in rejected)
+        if markerIds is None or len(markerCorners) == 0:
+            return markerCorners, markerIds, rejected
+        gray = frame if frame.ndim == 2 else cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        points = self.__fullResolution(numpy.concatenate(markerCorners).reshape(-1, 1, 2))
+        cv2.cornerSubPix(gray, points, (self.window, self.window), (-1, -1), PyramidDetector.CRITERIA)
+        return tuple(points.reshape(-1, 1, 4, 2)), markerIds, rejected
+
+    def __fullResolution(self, points):
+        # pixel centers of the downscaled image are between the original ones
+        return numpy.ascontiguousarray((points + 0.5) / self.scale - 0.5, dtype=numpy.float32)
+
+def calibrationMatrix(detector, frame):
+    markerCorners, markerIds, _ = detector.detectMarkers(frame)
+    markers = []
+    for i in range(len(markerCorners)):
+        if markerIds[i][0] == CALIBRATION_ID:
+            center = sum(markerCorners[i][0])/4
+            markers.append(center)
+
+    if len(markers) != 4:
+        print(f"{len(markers)} out of 4 calibration markers found")
+        return None
+    center_of_centers = sum(markers)/4
+    def clockwiseKey(x):
+        v = numpy.add(x, -center_of_centers)
+        angle = numpy.arccos(v[0]/numpy.dot(v, v))
+        if v[1] < 0: angle *= -1
+        return angle
+
+    markers.sort(key = clockwiseKey)
+    markers = numpy.float32(markers)
+
+    boundaries = numpy.float32([
+        [CALIBRATION_PADDING, CALIBRATION_PADDING],
+        [frame.shape[1]-CALIBRATION_PADDING, CALIBRATION_PADDING],
+        [frame.shape[1]-CALIBRATION_PADDING, frame.shape[1]-CALIBRATION_PADDING],
+        [CALIBRATION_PADDING, frame.shape[1]-CALIBRATION_PADDING],
+    ])
+    return cv2.getPerspectiveTransform(markers, boundaries)
+
+# Every actuator is a pair of (tip id, vertex id): two tip markers and one
+# vertex marker
+ACTUATORS = [(TIP_ID, VERTEX_ID)]
+
+def parseActuators(text):
+    # "8/9,10/11" -> [(8, 9), (10, 11)]
+    actuators = []
+    for pair in text.split(','):
+        tip, vertex = pair.split('/')
+        actuators.append((int(tip), int(vertex)))
+    return actuators
+
+def expectedMarkers(actuators):
+    # Number of markers of every id, as used by roi_tracking.RoiTracker
+    expected = {}
+    for tip, vertex in actuators:
+        expected[tip] = expected.get(tip, 0) + 2
+        expected[vertex] = expected.get(vertex, 0) + 1
+    return expected
+
+def groupMarkers(markerCorners, markerIds, actuators=ACTUATORS, precise=False):
+    # Returns the marker centers of every actuator, tips first, vertex last.
+    # The centers are truncated to integers unless precise is set, which keeps
+    # two decimals.
+    roles = {}
+    for index, (tip, vertex) in enumerate(actuators):
+        roles[tip] = (index, False)
+        roles[vertex] = (index, True)
+    groups = [[] for _ in actuators]
+    for i in range(len(markerCorners)):
+        role = roles.get(markerIds[i][0])
+        if role is None:
+            continue
+        center = sum(markerCorners[i][0])/4
+        center = [round(float(center[0]), 2), round(float(center[1]), 2)] if precise else [int(center[0]), int(center[1])]
+        index, is_vertex = role
+        if is_vertex:
+            groups[index].append(center)
+        else:
+            groups[index].insert(0, center)
+    return groups
+
+def actuatorMarkers(markerCorners, markerIds):
+    # tips first, vertex last
+    return groupMarkers(markerCorners, markerIds)[0]
+
+def transformMarkers(markers, matrix, precise=False):
+    result = []
+    for marker in markers:
+        point = cv2.perspectiveTransform(numpy.float32(marker).reshape(-1, 1, 2), matrix)
+        result.append([round(float(p), 2) if precise else int(p) for p in point[0][0]])
+    return result
+
+def markerAngle(markers, precise=False):
+    vector = []
+    vector.append(numpy.subtract(markers[2], markers[0]))
+    vector.append(numpy.subtract(markers[2], markers[1]))
+    vector.append(numpy.subtract(markers[0], markers[1]))
+    mag = [numpy.dot(v, v) for v in vector]
+
+    try:
+        angle = numpy.arccos((mag[0] + mag[1] - mag[2]) / (2*numpy.sqrt(mag[0]*mag[1])))
+        if precise:
+            if numpy.isnan(angle):
+                return -1
+            return round(float(angle * 180 / numpy.pi), 2)
+        return int((angle * 180 / numpy.pi))
+    except:
+        return -1
+
+def processActuators(detector, frame, actuators=ACTUATORS, matrix=None, precise=False):
+    # Returns the three points (tips first) and the angle of every actuator,
+    # or ([], -1) for actuators which were not found
+    markerCorners, markerIds, _ = detector.detectMarkers(frame)
+    results = []
+    for markers in groupMarkers(markerCorners, markerIds, actuators, precise):
+        if len(markers) != 3:
+            results.append(([], -1))
+            continue
+        if matrix is not None:
+            markers = transformMarkers(markers, matrix, precise)
+        results.append((markers, markerAngle(markers, precise)))
+    return results
+
+def processFrame(detector, frame, matrix=None):
+    # Returns the three points (tips first) and the angle, or ([], -1)
+    return processActuators(detector, frame, ACTUATORS, matrix)[0]
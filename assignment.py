@@ -0,0 +1,74 @@
+import numpy
+
+# Optimal assignment of tracked points to detected candidates, shared by the
+# blob trackers of actuator_points.py and actuator_perspective.py.
+
+def distanceMatrix(tracked, candidates):
+    # (tracked, candidates) matrix of Euclidean distances
+    tracked = numpy.asarray(tracked, dtype=numpy.float64).reshape(-1, 1, 2)
+    candidates = numpy.asarray(candidates, dtype=numpy.float64).reshape(1, -1, 2)
+    return numpy.sqrt(((tracked - candidates)**2).sum(axis=2))
+
+def solveAssignment(cost):
+    # Hungarian algorithm with potentials for a rectangular cost matrix, the
+    # inner loop over the columns is vectorized. Returns the row and column
+    # indices of the minimal total cost assignment, ordered by row.
+    cost = numpy.asarray(cost, dtype=numpy.float64)
+    n, m = cost.shape
+    if n > m:
+        columns, rows = solveAssignment(cost.T)
+        order = numpy.argsort(rows)
+        return rows[order], columns[order]
+    u = numpy.zeros(n+1)
+    v = numpy.zeros(m+1)
+    p = numpy.zeros(m+1, dtype=int) # row assigned to every column, 1-based
+    way = numpy.zeros(m+1, dtype=int)
+    for i in range(1, n+1):
+        p[0] = i
+        j0 = 0
+        minv = numpy.full(m+1, numpy.inf)
+        used = numpy.zeros(m+1, dtype=bool)
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            free = ~used
+            free[0] = False
+            reduced = cost[i0-1] - u[i0] - v[1:]
+            update = free[1:] & (reduced < minv[1:])
+            minv[1:][update] = reduced[update]
+            way[1:][update] = j0
+            candidates = numpy.where(free, minv, numpy.inf)
+            j1 = int(numpy.argmin(candidates))
+            delta = candidates[j1]
+            u[p[used]] += delta
+            v[used] -= delta
+            minv[free] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while j0 != 0:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+    columns = numpy.flatnonzero(p[1:])
+    rows = p[1:][columns] - 1
+    order = numpy.argsort(rows)
+    return rows[order], columns[order]
+
+def assignPoints(tracked, candidates, max_jump=None):
+    # Returns the candidate index of every tracked point, or -1 for points
+    # which would have to jump further than max_jump pixels
+    if len(tracked) == 0:
+        return []
+    if len(candidates) == 0:
+        return [-1]*len(tracked)
+    distances = distanceMatrix(tracked, candidates)
+    cost = distances
+    if max_jump is not None:
+        # gated pairs are only taken when nothing else is left
+        cost = numpy.where(distances > max_jump, distances.max()*len(tracked) + max_jump, distances)
+    assigned = [-1]*len(tracked)
+    for row, column in zip(*solveAssignment(cost)):
+        if max_jump is None or distances[row, column] <= max_jump:
+            assigned[row] = int(column)
+    return assigned
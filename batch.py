@@ -0,0 +1,129 @@
+import argparse
+import concurrent.futures
+import csv
+import json
+import os
+import time
+import aruco_core
+import replay
+import reprocess
+
+# Reprocesses every recording found below the given directories on one process
+# pool and writes a single table. Each finished chunk of frames is stored in
+# the checkpoint directory, so an interrupted run only processes what is left.
+
+def discover(roots):
+    recordings = []
+    for root in roots:
+        for directory, _, files in os.walk(root):
+            name = os.path.basename(os.path.normpath(directory))
+            if name + ".csv" in files or name + ".idx" in files:
+                recordings.append(os.path.normpath(directory))
+    return sorted(set(recordings))
+
+def recordingId(path):
+    return os.path.normpath(path).strip(os.sep).replace(os.sep, "__")
+
+def planRecording(path):
+    recording = replay.Recording(path)
+    return reprocess.planCalibration(recording, aruco_core.createDetector())
+
+def processChunk(path, frames, matrices, part_path):
+    recording = replay.Recording(path)
+    results = reprocess.processChunk(recording.template, recording.is_container, frames, matrices)
+    temporary_path = part_path + ".tmp"
+    with open(temporary_path, mode="w", newline="") as part_file:
+        writer = csv.writer(part_file)
+        for result in results:
+            writer.writerow(reprocess.resultRow(recording, result))
+    os.replace(temporary_path, part_path)
+    return len(results)
+
+class BatchRunner:
+    def __init__(self, recordings, checkpoint_dir, workers=None, chunk_size=256):
+        self.recordings = recordings
+        self.checkpoint_dir = checkpoint_dir
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.chunks = {} # recording -> number of chunks
+        self.processed_frames = 0
+        self.skipped_chunks = 0
+        self.failed = []
+
+    def __loadManifest(self):
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        manifest_path = os.path.join(self.checkpoint_dir, "manifest.json")
+        if os.path.isfile(manifest_path):
+            with open(manifest_path, mode="r") as manifest_file:
+                manifest = json.load(manifest_file)
+            if manifest["chunk_size"] != self.chunk_size:
+                raise ValueError(f"Checkpoint {self.checkpoint_dir} was written with chunk size {manifest['chunk_size']}, not {self.chunk_size}")
+        else:
+            with open(manifest_path, mode="w") as manifest_file:
+                json.dump({"chunk_size": self.chunk_size}, manifest_file)
+
+    def partPath(self, recording, chunk):
+        return os.path.join(self.checkpoint_dir, recordingId(recording), f"{chunk:06d}.csv")
+
+    def run(self):
+        self.__loadManifest()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as executor:
+            plans = {executor.submit(planRecording, recording): recording for recording in self.recordings}
+            pending = {}
+            for future in concurrent.futures.as_completed(plans):
+                recording = plans[future]
+                try:
+                    frames, matrices = future.result()
+                except Exception as e:
+                    print(f"{recording}: {e}")
+                    self.failed.append(recording)
+                    continue
+                os.makedirs(os.path.join(self.checkpoint_dir, recordingId(recording)), exist_ok=True)
+                chunks = [frames[i:i+self.chunk_size] for i in range(0, len(frames), self.chunk_size)]
+                self.chunks[recording] = len(chunks)
+                for i, chunk in enumerate(chunks):
+                    part_path = self.partPath(recording, i)
+                    if os.path.isfile(part_path):
+                        self.skipped_chunks += 1
+                        continue
+                    pending[executor.submit(processChunk, recording, chunk, matrices, part_path)] = recording
+            for future in concurrent.futures.as_completed(pending):
+                try:
+                    self.processed_frames += future.result()
+                except Exception as e:
+                    print(f"{pending[future]}: {e}")
+                    if pending[future] not in self.failed:
+                        self.failed.append(pending[future])
+
+    def writeTable(self, path):
+        with open(path, mode="w", newline="") as output_file:
+            writer = csv.writer(output_file)
+            writer.writerow(["recording"] + reprocess.HEAD)
+            for recording in self.recordings:
+                if recording in self.failed or recording not in self.chunks:
+                    continue
+                for i in range(self.chunks[recording]):
+                    with open(self.partPath(recording, i), mode="r", newline="") as part_file:
+                        for row in csv.reader(part_file):
+                            writer.writerow([recording] + row)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Recompute the angles of all recordings below the given directories")
+    parser.add_argument("input", nargs='+', help = "Directories to search for recordings")
+    parser.add_argument("-o", "--output", action='store', required=True, help = "Consolidated output CSV file")
+    parser.add_argument("-j", "--jobs", action='store', help = "Number of worker processes, all cores by default")
+    parser.add_argument("--checkpoint", action='store', help = "Checkpoint directory, <output>.parts by default")
+    parser.add_argument("--chunk-size", action='store', help = "Number of frames per task")
+    args = parser.parse_args()
+
+    recordings = discover(args.input)
+    print(f"Found {len(recordings)} recordings")
+    runner = BatchRunner(recordings,
+                         args.checkpoint if args.checkpoint != None else args.output + ".parts",
+                         int(args.jobs) if args.jobs != None else None,
+                         int(args.chunk_size) if args.chunk_size != None else 256)
+    start = time.perf_counter()
+    runner.run()
+    runner.writeTable(args.output)
+    elapsed = time.perf_counter() - start
+    print(f"Processed {runner.processed_frames} frames in {elapsed:.1f} s, {runner.skipped_chunks} chunks restored from checkpoint, {len(runner.failed)} recordings failed")
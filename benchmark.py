@@ -0,0 +1,237 @@
+import cv2
+import numpy
+import argparse
+import csv
+import math
+import time
+import aruco_core
+import actuator_points
+import actuator_perspective
+import detectors
+
+# Synthetic benchmark. Frames with the actuator bent at known angles are drawn
+# on a square plane, which is then tilted, projected to the camera resolution
+# and covered with noise. Every pipeline processes the same frame sequence
+# without a window, and the throughput, latency and angle error are reported.
+
+PLANE_SIZE = 1000
+ARM_LENGTH = 330
+ARUCO_SIZE = 80
+ARUCO_BORDER = 12
+SQUARE_SIZE = 28
+YELLOW = (0, 255, 255)
+WHITE = (255, 255, 255)
+
+DICTIONARY = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_4X4_50)
+
+def actuatorPoints(angle):
+    # vertex on top, the arms open downwards symmetrically
+    vertex = numpy.float64([PLANE_SIZE/2, PLANE_SIZE*0.3])
+    half = math.radians(angle/2)
+    tips = [vertex + ARM_LENGTH*numpy.float64([math.sin(s*half), math.cos(half)]) for s in (-1, 1)]
+    return tips[0], tips[1], vertex
+
+def drawAruco(plane, id, center):
+    marker = cv2.aruco.generateImageMarker(DICTIONARY, id, ARUCO_SIZE)
+    marker = cv2.copyMakeBorder(marker, ARUCO_BORDER, ARUCO_BORDER, ARUCO_BORDER, ARUCO_BORDER, cv2.BORDER_CONSTANT, value=255)
+    x = int(round(center[0] - marker.shape[1]/2))
+    y = int(round(center[1] - marker.shape[0]/2))
+    plane[y:y+marker.shape[0], x:x+marker.shape[1]] = marker[:, :, None]
+
+def arucoPlane(angle):
+    plane = numpy.full((PLANE_SIZE, PLANE_SIZE, 3), 255, dtype=numpy.uint8)
+    margin = ARUCO_SIZE
+    for center in [(margin, margin), (PLANE_SIZE-margin, margin), (PLANE_SIZE-margin, PLANE_SIZE-margin), (margin, PLANE_SIZE-margin)]:
+        drawAruco(plane, aruco_core.CALIBRATION_ID, center)
+    first, second, vertex = actuatorPoints(angle)
+    drawAruco(plane, aruco_core.TIP_ID, first)
+    drawAruco(plane, aruco_core.TIP_ID, second)
+    drawAruco(plane, aruco_core.VERTEX_ID, vertex)
+    return plane
+
+def blobPlane(angle):
+    # yellow actuator with white squares, which look like white spots on black
+    # in the blue channel
+    plane = numpy.full((PLANE_SIZE, PLANE_SIZE, 3), 255, dtype=numpy.uint8)
+    first, second, vertex = actuatorPoints(angle)
+    for tip in (first, second):
+        cv2.line(plane, numpy.int32(vertex), numpy.int32(tip), YELLOW, 3*SQUARE_SIZE)
+    for point in (first, second, vertex):
+        cv2.circle(plane, numpy.int32(point), 2*SQUARE_SIZE, YELLOW, -1)
+        corner = numpy.int32(point - SQUARE_SIZE/2)
+        cv2.rectangle(plane, corner, corner + SQUARE_SIZE, WHITE, -1)
+    return plane
+
+def tiltMatrix(resolution, tilt):
+    # The plane is rotated around its horizontal axis and projected with a
+    # pinhole camera, so that it fills 85% of the shorter side when not tilted
+    width, height = resolution
+    focal = max(width, height)
+    distance = focal / (0.85*min(width, height))
+    t = math.radians(tilt)
+    source = []
+    destination = []
+    for x, y in [(0, 0), (1, 0), (1, 1), (0, 1)]:
+        px, py = x - 0.5, y - 0.5
+        z = distance + py*math.sin(t)
+        source.append([x*PLANE_SIZE, y*PLANE_SIZE])
+        destination.append([width/2 + focal*px/z, height/2 + focal*py*math.cos(t)/z])
+    return cv2.getPerspectiveTransform(numpy.float32(source), numpy.float32(destination))
+
+def synthesizeFrames(plane_function, angles, resolution, tilt, noise, seed=0):
+    random = numpy.random.default_rng(seed)
+    matrix = tiltMatrix(resolution, tilt)
+    frames = []
+    for angle in angles:
+        frame = cv2.warpPerspective(plane_function(angle), matrix, resolution, borderValue=WHITE)
+        if noise > 0:
+            frame = numpy.clip(frame + random.normal(0, noise, frame.shape), 0, 255).astype(numpy.uint8)
+        frames.append(frame)
+    return frames
+
+class ArucoPipeline:
+    # The detection backend of actuator_aruco.py, so the benchmark measures
+    # what the application runs
+    name = "aruco"
+    plane = staticmethod(arucoPlane)
+
+    def __init__(self, roi=False, pyramid=None):
+        self.backend = detectors.ArucoBackend(pyramid_scale=pyramid, roi=roi)
+        self.matrix = None
+        if pyramid is not None:
+            self.name = "aruco-pyramid"
+        if roi:
+            self.name = "aruco-roi"
+
+    def calibrate(self, frame):
+        self.matrix = aruco_core.calibrationMatrix(self.backend.detector, frame)
+
+    def process(self, frame):
+        markers = self.backend.detect(frame)[0]
+        return self.backend.measure(markers, self.matrix)[1]
+
+class PointsPipeline:
+    name = "points"
+    plane = staticmethod(blobPlane)
+
+    def __init__(self):
+        self.app = actuator_points.Application()
+
+    def calibrate(self, frame):
+        pass
+
+    def process(self, frame):
+        return self.app.processFrame(frame)
+
+class PerspectivePipeline(PointsPipeline):
+    name = "perspective"
+
+    def __init__(self, caching=False):
+        self.app = actuator_perspective.Application()
+        self.app.matrix_caching = caching
+        if caching:
+            self.name = "perspective-cached"
+
+PIPELINES = {
+    "aruco": lambda scale: ArucoPipeline(),
+    "aruco-roi": lambda scale: ArucoPipeline(roi=True),
+    "aruco-pyramid": lambda scale: ArucoPipeline(pyramid=scale),
+    "points": lambda scale: PointsPipeline(),
+    "perspective": lambda scale: PerspectivePipeline(),
+    "perspective-cached": lambda scale: PerspectivePipeline(caching=True),
+}
+
+def runBenchmark(pipeline, frames, angles, repeat=1):
+    pipeline.calibrate(frames[0])
+    latencies = []
+    errors = []
+    found = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for frame, truth in zip(frames, angles):
+            frame_start = time.perf_counter()
+            angle = pipeline.process(frame.copy())
+            latencies.append(time.perf_counter() - frame_start)
+            if angle is not None and angle >= 0:
+                found += 1
+                errors.append(abs(angle - truth))
+    elapsed = time.perf_counter() - start
+    latencies = numpy.float64(latencies) * 1000
+    errors = numpy.float64(errors)
+    return {
+        "fps": len(latencies) / elapsed,
+        "p50_ms": numpy.percentile(latencies, 50),
+        "p90_ms": numpy.percentile(latencies, 90),
+        "p99_ms": numpy.percentile(latencies, 99),
+        "found": found / len(latencies),
+        "mean_error": errors.mean() if len(errors) else float("nan"),
+        "max_error": errors.max() if len(errors) else float("nan"),
+    }
+
+def runStepChange(pipeline, frames, truth, settle):
+    # The plane tilt changes in the middle of the frames. Returns the angles
+    # of the second half and their error from the first frame on which the
+    # change should have settled, so that cached and smoothed state which
+    # does not follow the change shows up as a lasting error.
+    pipeline.calibrate(frames[0])
+    angles = [pipeline.process(frame.copy()) for frame in frames]
+    after = angles[len(angles)//2:]
+    errors = numpy.float64([abs(angle - truth) if angle is not None and angle >= 0 else numpy.nan for angle in after[settle:]])
+    return after, errors
+
+def parseResolution(text):
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+HEAD = ["pipeline", "resolution", "tilt", "noise", "fps", "p50_ms", "p90_ms", "p99_ms", "found", "mean_error", "max_error"]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmark the detection pipelines on synthetic frames")
+    parser.add_argument("-p", "--pipelines", action='store', default="aruco,points,perspective", help = f"Comma separated list of {', '.join(PIPELINES)}")
+    parser.add_argument("-r", "--resolutions", action='store', default="640x480,1280x720,1920x1080", help = "Comma separated list of WIDTHxHEIGHT")
+    parser.add_argument("-t", "--tilts", action='store', default="0,30", help = "Comma separated list of plane tilts in degrees")
+    parser.add_argument("-n", "--noise", action='store', default="0,8", help = "Comma separated list of noise standard deviations")
+    parser.add_argument("-a", "--angles", action='store', default="20,160,5", help = "First angle, last angle and step in degrees")
+    parser.add_argument("-s", "--scale", action='store', default="0.5", help = "Detection scale of the aruco-pyramid pipeline")
+    parser.add_argument("--repeat", action='store', default="1", help = "Number of passes over the frames")
+    parser.add_argument("--step", action='store', help = "TILT_A,TILT_B: hold the first angle at one tilt, then at the other, instead of the sweep")
+    parser.add_argument("--step-frames", action='store', default="10", help = "Number of frames at each tilt of --step")
+    parser.add_argument("--settle", action='store', default="4", help = "Number of frames after the tilt change which are not counted")
+    parser.add_argument("-o", "--output", action='store', help = "Output CSV file")
+    args = parser.parse_args()
+
+    first, last, step = [float(a) for a in args.angles.split(',')]
+    angles = list(numpy.arange(first, last + step/2, step))
+    if args.step != None:
+        tilts = [float(t) for t in args.step.split(',')]
+        count = int(args.step_frames)
+        print(("{:<18} {:>10} {:>9} {:>5} {:>10} {:>9}  {}").format("pipeline", "resolution", "tilts", "noise", "mean_error", "max_error", "angles after the change"))
+        for name in args.pipelines.split(','):
+            for resolution in [parseResolution(r) for r in args.resolutions.split(',')]:
+                for noise in [float(n) for n in args.noise.split(',')]:
+                    pipeline = PIPELINES[name](float(args.scale))
+                    frames = []
+                    for tilt in tilts:
+                        frames += synthesizeFrames(pipeline.plane, [first]*count, resolution, tilt, noise)
+                    after, errors = runStepChange(pipeline, frames, first, int(args.settle))
+                    print(("{:<18} {:>10} {:>9} {:>5.0f} {:>10.2f} {:>9.2f}  {}").format(name, f"{resolution[0]}x{resolution[1]}",
+                          f"{tilts[0]:.0f}->{tilts[1]:.0f}", noise, numpy.nanmean(errors) if len(errors) else numpy.nan,
+                          numpy.nanmax(errors) if len(errors) else numpy.nan, " ".join(str(angle) for angle in after)))
+    else:
+        rows = []
+        print(("{:<18} {:>10} {:>5} {:>5} {:>8} {:>8} {:>8} {:>8} {:>6} {:>10} {:>9}").format(*HEAD))
+        for name in args.pipelines.split(','):
+            for resolution in [parseResolution(r) for r in args.resolutions.split(',')]:
+                for tilt in [float(t) for t in args.tilts.split(',')]:
+                    for noise in [float(n) for n in args.noise.split(',')]:
+                        pipeline = PIPELINES[name](float(args.scale))
+                        frames = synthesizeFrames(pipeline.plane, angles, resolution, tilt, noise)
+                        result = runBenchmark(pipeline, frames, angles, int(args.repeat))
+                        row = [name, f"{resolution[0]}x{resolution[1]}", tilt, noise] + [result[k] for k in HEAD[4:]]
+                        rows.append(row)
+                        print(("{:<18} {:>10} {:>5.0f} {:>5.0f} {:>8.1f} {:>8.2f} {:>8.2f} {:>8.2f} {:>6.2f} {:>10.2f} {:>9.2f}").format(*row))
+        if args.output != None:
+            with open(args.output, mode="w", newline="") as output_file:
+                writer = csv.writer(output_file)
+                writer.writerow(HEAD)
+                writer.writerows(rows)
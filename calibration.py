@@ -0,0 +1,61 @@
+import numpy
+import json
+import os
+
+# Perspective calibrations are kept on disk, keyed by the input source and the
+# frame resolution, and written into recordings as '# calibration' rows
+# followed by the nine matrix values. A row without values means the
+# calibration was turned off.
+CALIBRATION_ROW = "# calibration"
+
+def calibrationRow(matrix):
+    if matrix is None:
+        return [CALIBRATION_ROW]
+    return [CALIBRATION_ROW] + [repr(float(value)) for value in numpy.asarray(matrix).flatten()]
+
+def parseCalibrationRow(data):
+    if len(data) < 10:
+        return None
+    return numpy.float64(data[1:10]).reshape(3, 3)
+
+def calibrationPayload(matrix):
+    return numpy.asarray(matrix, dtype="<f8").tobytes()
+
+def parseCalibrationPayload(payload):
+    return numpy.frombuffer(payload, dtype="<f8").reshape(3, 3).copy()
+
+class CalibrationCache:
+    def __init__(self, path):
+        self.path = path
+        self.calibrations = {}
+        if os.path.isfile(path):
+            try:
+                with open(path, mode="r") as cache_file:
+                    self.calibrations = json.load(cache_file)
+            except (OSError, ValueError) as e:
+                print(f"Could not read calibration cache {path}: {e}")
+
+    @staticmethod
+    def key(source, shape):
+        return f"{source}@{shape[1]}x{shape[0]}"
+
+    def load(self, source, shape):
+        values = self.calibrations.get(CalibrationCache.key(source, shape))
+        if values is None:
+            return None
+        return numpy.float64(values).reshape(3, 3)
+
+    def save(self, source, shape, matrix):
+        key = CalibrationCache.key(source, shape)
+        if matrix is None:
+            if key not in self.calibrations:
+                return
+            del self.calibrations[key]
+        else:
+            self.calibrations[key] = numpy.asarray(matrix, dtype=float).flatten().tolist()
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, mode="w") as cache_file:
+            json.dump(self.calibrations, cache_file, indent=1)
+        os.replace(temporary_path, self.path)
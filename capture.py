@@ -0,0 +1,86 @@
+import cv2
+import collections
+import threading
+import time
+
+class ThreadedCapture:
+    # Drop-in replacement for cv2.VideoCapture. A background thread owns the
+    # capture device and keeps at most queue_depth frames, dropping the oldest.
+    def __init__(self, source, queue_depth=1):
+        self.video_capture = cv2.VideoCapture(source)
+        self.queue = collections.deque(maxlen=max(1, int(queue_depth)))
+        self.condition = threading.Condition()
+        self.running = True
+        self.success = True
+        self.timestamp = 0
+        self.captured_frames = 0
+        self.consumed_frames = 0
+        self.dropped_frames = 0
+        self.max_queue_depth = 0
+        self.thread = threading.Thread(target=self.__capture, daemon=True)
+        self.thread.start()
+
+    def __capture(self):
+        while self.running:
+            success, frame = self.video_capture.read()
+            timestamp = time.clock_gettime(time.CLOCK_REALTIME)
+            with self.condition:
+                if not success:
+                    self.success = False
+                    self.condition.notify_all()
+                    return
+                if len(self.queue) == self.queue.maxlen:
+                    self.dropped_frames += 1
+                self.queue.append((timestamp, frame))
+                self.captured_frames += 1
+                self.max_queue_depth = max(self.max_queue_depth, len(self.queue))
+                self.condition.notify_all()
+
+    def read(self):
+        with self.condition:
+            while not self.queue and self.success and self.running:
+                self.condition.wait()
+            if not self.queue:
+                return False, None
+            self.timestamp, frame = self.queue.popleft()
+            self.consumed_frames += 1
+            return True, frame
+
+    # Non-blocking read: (True, None) while no new frame is queued and
+    # (False, None) after the capture has ended
+    def poll(self):
+        with self.condition:
+            if not self.queue:
+                return self.success and self.running, None
+            self.timestamp, frame = self.queue.popleft()
+            self.consumed_frames += 1
+            return True, frame
+
+    # True once the capture has ended and every queued frame was read
+    def finished(self):
+        with self.condition:
+            return not self.queue and not (self.success and self.running)
+
+    def queueDepth(self):
+        with self.condition:
+            return len(self.queue)
+
+    def stats(self):
+        with self.condition:
+            return {
+                "captured": self.captured_frames,
+                "consumed": self.consumed_frames,
+                "dropped": self.dropped_frames,
+                "queue_depth": len(self.queue),
+                "max_queue_depth": self.max_queue_depth,
+            }
+
+    def isOpened(self):
+        return self.video_capture.isOpened()
+
+    def release(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join()
+        self.video_capture.release()
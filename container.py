@@ -0,0 +1,262 @@
+import cv2
+import numpy
+import struct
+import threading
+import argparse
+import csv
+import os
+import calibration
+
+# A recording is stored as a few large chunk files holding the encoded frames
+# back to back, and an index file with one fixed-size record per frame or event:
+#   <dir>/<name>.idx
+#   <dir>/<name>_00000.chunk, <dir>/<name>_00001.chunk, ...
+MAGIC = b"ACTIDX01"
+RECORD_FORMAT = "<BBHQIId6ff"
+RECORD_DTYPE = numpy.dtype([
+    ("kind", "u1"),
+    ("vertex", "u1"),
+    ("chunk", "<u2"),
+    ("offset", "<u8"),
+    ("orig_length", "<u4"),
+    ("marked_length", "<u4"),
+    ("timestamp", "<f8"),
+    ("points", "<f4", (6,)),
+    ("angle", "<f4"),
+])
+assert struct.calcsize(RECORD_FORMAT) == RECORD_DTYPE.itemsize
+
+KIND_FRAME = 0
+KIND_CALIBRATION = 1 # with a matrix payload, or a C key press without one
+KIND_UNCALIBRATED = 2
+KIND_ACTUATOR = 3 # a further actuator of the preceding frame, numbered by the chunk field
+
+# The highest bit of the vertex field marks frames whose points were predicted
+# instead of detected
+PREDICTED_FLAG = 0x80
+VERTEX_MASK = 0x7f
+
+CALIBRATION_COMMENT = "# c pressed"
+
+def indexPath(template):
+    return template + ".idx"
+
+def chunkPath(template, chunk):
+    return f"{template}_{chunk:05d}.chunk"
+
+def isContainer(template):
+    return os.path.isfile(indexPath(template))
+
+def recordingHead(actuators=1):
+    head = ["x1", "y1", "x2", "y2", "x3", "y3", "mid", "angle","orig_path", "marked_path", "measured"]
+    for i in range(2, actuators+1):
+        head += [f"{name}_{i}" for name in head[0:8]]
+    return head
+
+def actuatorColumns(markers, angle):
+    if len(markers) != 3:
+        return [-1, -1, -1, -1, -1, -1, 3] + [angle]
+    return [number for point in markers for number in point] + [3] + [angle]
+
+def isMeasured(row):
+    # The measured column was added after marked_path, older rows have none
+    return len(row) <= 10 or str(row[10]) != "0"
+
+def windowTimestamp(path):
+    # Frame names end with the window id built in __drawWindow(), which is the
+    # realtime clock with the decimal point removed, padded to 17 digits.
+    window_id = os.path.splitext(path)[0]
+    window_id = window_id[window_id.rfind('_')+1 :]
+    try:
+        return int(window_id) / 1e7
+    except ValueError:
+        return 0.0
+
+class ContainerWriter:
+    CHUNK_SIZE = 1 << 30
+
+    def __init__(self, template, image_format=".png", chunk_size=CHUNK_SIZE):
+        self.template = template
+        self.image_format = image_format
+        self.chunk_size = chunk_size
+        self.chunk = 0
+        self.chunk_file = open(chunkPath(template, self.chunk), mode="wb")
+        self.offset = 0
+        self.index_file = open(indexPath(template), mode="wb")
+        self.index_file.write(MAGIC)
+        self.frames = 0
+
+    def encode(self, name, frame):
+        success, data = cv2.imencode(self.image_format, frame)
+        if not success:
+            raise RuntimeError(f"Could not encode frame {name}")
+        return data.tobytes()
+
+    def __append(self, data):
+        if self.offset > 0 and self.offset + len(data) > self.chunk_size:
+            self.chunk_file.close()
+            self.chunk += 1
+            self.chunk_file = open(chunkPath(self.template, self.chunk), mode="wb")
+            self.offset = 0
+        offset = self.offset
+        self.chunk_file.write(data)
+        self.offset += len(data)
+        return offset
+
+    def writeFrame(self, timestamp, points, vertex, angle, orig, marked=b"", measured=True):
+        offset = self.__append(orig + marked)
+        points = [float(p) for p in points]
+        if len(points) != 6:
+            points = [-1.0]*6
+        vertex = int(vertex) if measured else int(vertex) | PREDICTED_FLAG
+        self.index_file.write(struct.pack(RECORD_FORMAT, KIND_FRAME, vertex, self.chunk, offset,
+                                          len(orig), len(marked), timestamp, *points, float(angle)))
+        self.frames += 1
+
+    def writeActuator(self, actuator, timestamp, points, vertex, angle, measured=True):
+        points = [float(p) for p in points]
+        if len(points) != 6:
+            points = [-1.0]*6
+        vertex = int(vertex) if measured else int(vertex) | PREDICTED_FLAG
+        self.index_file.write(struct.pack(RECORD_FORMAT, KIND_ACTUATOR, vertex, actuator, 0,
+                                          0, 0, timestamp, *points, float(angle)))
+
+    def writeEvent(self, kind, payload=b"", timestamp=0.0):
+        offset = self.__append(payload)
+        self.index_file.write(struct.pack(RECORD_FORMAT, kind, 0, self.chunk, offset,
+                                          len(payload), 0, timestamp, *([-1.0]*6), -1.0))
+
+    def writeCalibration(self, matrix):
+        if matrix is None:
+            self.writeEvent(KIND_UNCALIBRATED)
+        else:
+            self.writeEvent(KIND_CALIBRATION, calibration.calibrationPayload(matrix))
+
+    # commit(row, results) follows the CSV row layout, so the container can be
+    # used wherever a CSV writer is used, including by recorder.AsyncRecorder
+    def commit(self, row, results):
+        if len(row) == 1 and row[0] == CALIBRATION_COMMENT:
+            self.writeEvent(KIND_CALIBRATION)
+            return
+        if len(row) > 0 and row[0] == calibration.CALIBRATION_ROW:
+            self.writeCalibration(calibration.parseCalibrationRow(row))
+            return
+        timestamp = windowTimestamp(row[8]) if len(row) > 8 else 0.0
+        orig = results[0] if len(results) > 0 else b""
+        marked = results[1] if len(results) > 1 else b""
+        self.writeFrame(timestamp, row[0:6], row[6], row[7], orig, marked, isMeasured(row))
+        self.writeActuators(timestamp, row)
+
+    def writeActuators(self, timestamp, row):
+        # Columns of the further actuators follow the measured column
+        for actuator, start in enumerate(range(11, len(row) - 7, 8), 1):
+            group = row[start : start+8]
+            self.writeActuator(actuator, timestamp, group[0:6], group[6], group[7], isMeasured(row))
+
+    def close(self):
+        self.chunk_file.close()
+        self.index_file.close()
+
+class ContainerReader:
+    def __init__(self, template):
+        self.template = template
+        with open(indexPath(template), mode="rb") as index_file:
+            if index_file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{indexPath(template)} is not a recording index")
+        self.records = numpy.fromfile(indexPath(template), dtype=RECORD_DTYPE, offset=len(MAGIC))
+        self.frame_indices = numpy.flatnonzero(self.records["kind"] == KIND_FRAME)
+        self.chunk_files = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.records)
+
+    def record(self, index):
+        return self.records[index]
+
+    def readBytes(self, index, marked=False):
+        record = self.records[index]
+        offset = int(record["offset"])
+        length = int(record["orig_length"])
+        if marked:
+            offset += length
+            length = int(record["marked_length"])
+        with self.lock:
+            chunk = int(record["chunk"])
+            if chunk not in self.chunk_files:
+                self.chunk_files[chunk] = open(chunkPath(self.template, chunk), mode="rb")
+            chunk_file = self.chunk_files[chunk]
+            chunk_file.seek(offset)
+            return chunk_file.read(length)
+
+    # Returns the records of the further actuators of a frame
+    def actuators(self, index):
+        end = index + 1
+        while end < len(self.records) and self.records[end]["kind"] == KIND_ACTUATOR:
+            end += 1
+        return self.records[index+1 : end]
+
+    # Returns the matrix of a calibration record, None if the calibration was
+    # turned off, or CALIBRATION_COMMENT for a C key press without a matrix
+    def readCalibration(self, index):
+        if self.records[index]["kind"] == KIND_UNCALIBRATED:
+            return None
+        payload = self.readBytes(index)
+        if len(payload) == 0:
+            return CALIBRATION_COMMENT
+        return calibration.parseCalibrationPayload(payload)
+
+    def readFrame(self, index, marked=False):
+        data = self.readBytes(index, marked)
+        if len(data) == 0:
+            return None
+        return cv2.imdecode(numpy.frombuffer(data, dtype=numpy.uint8), cv2.IMREAD_COLOR)
+
+    def close(self):
+        with self.lock:
+            for chunk_file in self.chunk_files.values():
+                chunk_file.close()
+            self.chunk_files.clear()
+
+def convert(source, destination, chunk_size=ContainerWriter.CHUNK_SIZE):
+    # Copies the PNG files of a CSV recording into a container without
+    # decoding or re-encoding them.
+    source_template = source + '/' + source[source.rfind('/')+1 :]
+    os.makedirs(destination, exist_ok=True)
+    destination_template = destination + '/' + destination[destination.rfind('/')+1 :]
+    writer = ContainerWriter(destination_template, chunk_size=chunk_size)
+    skipped = 0
+    with open(source_template+".csv", mode="r") as input_file_csv:
+        input_reader = csv.reader(input_file_csv)
+        next(input_reader)
+        for data in input_reader:
+            if data == [CALIBRATION_COMMENT]:
+                writer.writeEvent(KIND_CALIBRATION)
+                continue
+            if len(data) > 0 and data[0] == calibration.CALIBRATION_ROW:
+                writer.writeCalibration(calibration.parseCalibrationRow(data))
+                continue
+            if len(data) < 10 or not os.path.isfile(data[8]):
+                skipped += 1
+                continue
+            with open(data[8], mode="rb") as f:
+                orig = f.read()
+            marked = b""
+            if os.path.isfile(data[9]):
+                with open(data[9], mode="rb") as f:
+                    marked = f.read()
+            writer.writeFrame(windowTimestamp(data[8]), data[0:6], data[6], data[7], orig, marked, isMeasured(data))
+            writer.writeActuators(windowTimestamp(data[8]), data)
+    writer.close()
+    print(f"Converted {writer.frames} frames from {source} to {destination}, skipped {skipped} rows")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Convert a CSV and PNG recording into a container recording")
+    parser.add_argument("input", help = "Recording directory written with the PNG format")
+    parser.add_argument("output", help = "Destination directory")
+    parser.add_argument("--chunk-size", action='store', help = "Maximum chunk file size in megabytes")
+    args = parser.parse_args()
+    chunk_size = ContainerWriter.CHUNK_SIZE
+    if args.chunk_size != None:
+        chunk_size = int(args.chunk_size) << 20
+    convert(args.input, args.output, chunk_size)
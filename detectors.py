@@ -0,0 +1,137 @@
+import cv2
+import numpy
+import time
+import aruco_core
+import actuator_points
+import actuator_perspective
+from roi_tracking import RoiTracker
+
+# Detection backends of actuator_aruco.Application. Every backend has
+#   name
+#   actuators  the number of actuators it finds in one frame, None for any
+#   precise    whether the points are floats instead of integers
+#   roi_tracker  the roi_tracking.RoiTracker it uses, or None
+#   detect(frame)  the centers of every actuator, tips first and vertex last,
+#                  or [] for an actuator which was not found
+#   measure(markers, matrix)  the centers in the measurement plane and the
+#                  angle, matrix is the perspective calibration or None
+
+BACKENDS = ["aruco", "points", "perspective"]
+PROBE_FRAMES = 10
+PROBE_MIN_FOUND = 0.9 # share of the probe frames with all points found
+PROBE_TOLERANCE = 2.0 # degrees from the angles of the reference backend
+
+def measureMarkers(markers, matrix=None, precise=False):
+    if len(markers) != 3:
+        return markers, -1
+    if matrix is not None:
+        markers = aruco_core.transformMarkers(markers, matrix, precise)
+    return markers, aruco_core.markerAngle(markers, precise)
+
+class ArucoBackend:
+    name = "aruco"
+    actuators = None
+
+    def __init__(self, actuators=aruco_core.ACTUATORS, detector=None, pyramid_scale=None, roi=False, roi_padding=1.0, roi_fallback="immediate"):
+        self.actuator_ids = list(actuators)
+        self.detector = detector if detector is not None else aruco_core.createDetector()
+        self.precise = pyramid_scale is not None
+        self.marker_detector = self.detector
+        if self.precise:
+            self.marker_detector = aruco_core.PyramidDetector(self.detector, pyramid_scale)
+        self.roi_tracker = None
+        if roi:
+            self.roi_tracker = RoiTracker(self.marker_detector, aruco_core.expectedMarkers(self.actuator_ids), roi_padding, roi_fallback)
+
+    def detect(self, frame):
+        if self.roi_tracker is None:
+            markerCorners, markerIds, _ = self.marker_detector.detectMarkers(frame)
+        else:
+            markerCorners, markerIds = self.roi_tracker.detectMarkers(frame)
+        return aruco_core.groupMarkers(markerCorners, markerIds, self.actuator_ids, self.precise)
+
+    def measure(self, markers, matrix=None):
+        return measureMarkers(markers, matrix, self.precise)
+
+class PointsBackend:
+    # White spots in the blue channel, tracked from frame to frame by
+    # actuator_points.Application
+    name = "points"
+    actuators = 1
+    precise = False
+    roi_tracker = None
+
+    def __init__(self):
+        self.app = actuator_points.Application()
+
+    def detect(self, frame):
+        self.app.processFrame(frame)
+        if not self.app.points_success:
+            return [[]]
+        points = [list(point) for point in self.app.prev_points]
+        vertex = points.pop(self.app.mid_point)
+        return [points + [vertex]]
+
+    def measure(self, markers, matrix=None):
+        return measureMarkers(markers, matrix)
+
+class PerspectiveBackend(PointsBackend):
+    # Square spots whose vertex square gives its own perspective transform,
+    # the calibration matrix is not used
+    name = "perspective"
+
+    def __init__(self, caching=False):
+        self.app = actuator_perspective.Application()
+        self.app.matrix_caching = caching
+
+    def measure(self, markers, matrix=None):
+        if len(markers) != 3 or self.app.matrix is None:
+            return markers, -1
+        # as in actuator_perspective.py, only the first two rows are applied
+        points = cv2.transform(numpy.float64(markers).reshape(-1, 1, 2), self.app.matrix[0:2]).reshape(-1, 2)
+        return [[int(x), int(y)] for x, y in points], aruco_core.markerAngle(points)
+
+def probeBackends(backends, frames, tolerance=PROBE_TOLERANCE):
+    # Times every backend on the same frames. Returns the median time per
+    # frame, the share of frames in which all points of every actuator were
+    # found, and the share of frames in which they were found and the angles
+    # agree with the first backend, for every backend. The first backend is
+    # the reference: a frame it did not measure only needs all points found.
+    results = []
+    reference = None
+    for backend in backends:
+        times = []
+        angles = []
+        found = 0
+        agreed = 0
+        for i, frame in enumerate(frames):
+            start = time.perf_counter()
+            groups = backend.detect(frame)
+            frame_angles = [backend.measure(markers)[1] for markers in groups]
+            times.append(time.perf_counter() - start)
+            complete = all(len(markers) == 3 for markers in groups)
+            angles.append(frame_angles if complete else None)
+            if not complete:
+                continue
+            found += 1
+            expected = reference[i] if reference is not None else None
+            if expected is None or (len(expected) == len(frame_angles) and
+                    all(abs(a - b) <= tolerance for a, b in zip(frame_angles, expected))):
+                agreed += 1
+        if reference is None:
+            reference = angles
+        results.append({
+            "backend": backend,
+            "name": backend.name,
+            "ms": float(numpy.median(times)) * 1000,
+            "found": found / max(len(frames), 1),
+            "agreed": agreed / max(len(frames), 1),
+        })
+    return results
+
+def selectBackend(results, min_found=PROBE_MIN_FOUND):
+    # The fastest reliable backend, or None if none of them is reliable
+    reliable = [result for result in results if result["agreed"] >= min_found]
+    if len(reliable) == 0:
+        return None
+    return min(reliable, key=lambda result: result["ms"])["backend"]
@@ -0,0 +1,101 @@
+import numpy
+from multiprocessing import shared_memory
+
+class FrameRing:
+    # Preallocated frame slots in shared memory, written by one capture process
+    # and read as NumPy views by any number of other processes. Frames are
+    # numbered from 0 and frame n goes to slot n % slots. Every slot has a
+    # sequence counter which is 2n+1 while frame n is written and 2n+2 when it
+    # is complete (a seqlock), so a reader checks with valid(n) after using a
+    # view whether the slot was overwritten in the meantime.
+    # Layout: written frames, finished flag, slot counters, slot timestamps,
+    # then the frames, each starting on a 64 byte boundary.
+    ALIGNMENT = 64
+
+    def __init__(self, shape, slots=8, name=None):
+        self.shape = tuple(shape)
+        self.slots = int(slots)
+        self.owner = name is None
+        frame_size = int(numpy.prod(self.shape))
+        self.frame_stride = -(-frame_size // FrameRing.ALIGNMENT) * FrameRing.ALIGNMENT
+        self.data_offset = -(-8*(2 + 2*self.slots) // FrameRing.ALIGNMENT) * FrameRing.ALIGNMENT
+        size = self.data_offset + self.slots*self.frame_stride
+        if self.owner:
+            self.memory = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+        self.__map()
+        if self.owner:
+            self.header[:] = 0
+            self.counters[:] = 0
+
+    def __map(self):
+        buffer = self.memory.buf
+        self.header = numpy.ndarray((2,), dtype=numpy.int64, buffer=buffer)
+        self.counters = numpy.ndarray((self.slots,), dtype=numpy.int64, buffer=buffer, offset=16)
+        self.timestamps = numpy.ndarray((self.slots,), dtype=numpy.float64, buffer=buffer, offset=16 + 8*self.slots)
+        self.frames = numpy.ndarray((self.slots,) + self.shape, dtype=numpy.uint8, buffer=buffer, offset=self.data_offset,
+                                    strides=(self.frame_stride,) + numpy.empty(self.shape, dtype=numpy.uint8).strides)
+
+    # Another process attaches to the same memory by name
+    def __getstate__(self):
+        return {"shape": self.shape, "slots": self.slots, "name": self.memory.name}
+
+    def __setstate__(self, state):
+        self.__init__(state["shape"], state["slots"], state["name"])
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def beginWrite(self):
+        # Returns the number of the next frame and the view of its slot, which
+        # can be filled in place, e.g. by VideoCapture.read(view)
+        sequence = int(self.header[0])
+        slot = sequence % self.slots
+        self.counters[slot] = 2*sequence + 1
+        return sequence, self.frames[slot]
+
+    def endWrite(self, sequence, timestamp):
+        slot = sequence % self.slots
+        self.timestamps[slot] = timestamp
+        self.counters[slot] = 2*sequence + 2
+        self.header[0] = sequence + 1
+
+    def write(self, frame, timestamp):
+        sequence, view = self.beginWrite()
+        numpy.copyto(view, frame)
+        self.endWrite(sequence, timestamp)
+        return sequence
+
+    def finish(self):
+        # Marks the end of the capture, no more frames will be written
+        self.header[1] = 1
+
+    def finished(self):
+        return bool(self.header[1])
+
+    def written(self):
+        return int(self.header[0])
+
+    def latest(self):
+        # Number of the newest complete frame, -1 before the first one
+        return int(self.header[0]) - 1
+
+    def valid(self, sequence):
+        return sequence >= 0 and int(self.counters[sequence % self.slots]) == 2*sequence + 2
+
+    def read(self, sequence):
+        # Returns the capture timestamp and a view of the frame without copying
+        # it, or (None, None) if the frame is not in the ring any more. The view
+        # stays usable only as long as valid(sequence) holds.
+        if not self.valid(sequence):
+            return None, None
+        slot = sequence % self.slots
+        return float(self.timestamps[slot]), self.frames[slot]
+
+    def close(self):
+        self.header = self.counters = self.timestamps = self.frames = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
@@ -0,0 +1,287 @@
+import cv2
+import numpy
+import argparse
+import collections
+import concurrent.futures
+import csv
+import os
+import threading
+import time
+import aruco_core
+import calibration
+import container
+from capture import ThreadedCapture
+from recorder import AsyncRecorder
+
+# Several cameras in one process. Every camera is read on its own capture
+# thread, and the frames are detected on one shared pool of worker threads.
+# The cameras take turns submitting frames and each camera has at most one
+# frame in flight, so a fast camera cannot starve the others. Every camera
+# keeps its own calibration, recording directory and statistics.
+
+_local = threading.local()
+
+def detect(frame, matrix, actuators, calibrate):
+    # Runs on a pool thread, each of which has its own detector
+    if not hasattr(_local, "detector"):
+        _local.detector = aruco_core.createDetector()
+    if calibrate and matrix is None:
+        matrix = aruco_core.calibrationMatrix(_local.detector, frame)
+    return matrix, aruco_core.processActuators(_local.detector, frame, actuators, matrix)
+
+def windowId(timestamp):
+    # Same naming as Application.__drawWindow(), so container.windowTimestamp()
+    # recovers the capture time
+    return str(timestamp).replace('.', '').ljust(17, '0')
+
+class Camera:
+    def __init__(self, index, source, queue_depth=1):
+        self.index = index
+        self.source = source
+        self.name = f"camera{index}"
+        self.capture = ThreadedCapture(source, queue_depth)
+        self.active = True
+        self.matrix = None
+        self.calibration_loaded = False
+        self.future = None
+        self.frame = None
+        self.timestamp = 0
+        self.submitted = 0
+        self.results = []
+        self.processed_frames = 0
+        self.window_frames = 0
+        self.latencies = collections.deque(maxlen=1000)
+        self.waits = collections.deque(maxlen=1000)
+        self.output_template = None
+        self.output_file_csv = None
+        self.output_container = None
+        self.recorder = None
+        self.recorded_calibration = None
+
+    def setOutput(self, directory, recording_format, actuators):
+        os.makedirs(directory, exist_ok=True)
+        self.output_template = directory + '/' + directory[directory.rfind('/')+1 :]
+        if recording_format == "container":
+            self.output_container = container.ContainerWriter(self.output_template)
+            encode = self.output_container.encode
+            commit = self.output_container.commit
+        else:
+            self.output_file_csv = open(self.output_template+".csv", mode="w")
+            writer = csv.writer(self.output_file_csv)
+            writer.writerow(container.recordingHead(len(actuators)))
+            encode = lambda name, frame: cv2.imwrite(name, frame)
+            commit = lambda row, results: writer.writerow(row)
+        self.recorder = AsyncRecorder(encode, commit)
+
+    def record(self):
+        state = self.matrix.tobytes() if self.matrix is not None else b""
+        if state != self.recorded_calibration:
+            self.recorder.writeRow(calibration.calibrationRow(self.matrix))
+            self.recorded_calibration = state
+        name = f"{self.output_template}_orig_{windowId(self.timestamp)}.png"
+        columns = [container.actuatorColumns(markers, angle) for markers, angle in self.results]
+        data = columns[0] + [name, "", 1]
+        for group in columns[1:]:
+            data += group
+        self.recorder.submit(data, [(name, self.frame)])
+
+    def stats(self):
+        capture = self.capture.stats()
+        latencies = numpy.float64(self.latencies) * 1000
+        waits = numpy.float64(self.waits) * 1000
+        return {
+            "captured": capture["captured"],
+            "processed": self.processed_frames,
+            "dropped": capture["dropped"],
+            "served": self.processed_frames / max(capture["captured"], 1),
+            "latency_p50_ms": numpy.percentile(latencies, 50) if len(latencies) else numpy.nan,
+            "latency_p99_ms": numpy.percentile(latencies, 99) if len(latencies) else numpy.nan,
+            "wait_p50_ms": numpy.percentile(waits, 50) if len(waits) else numpy.nan,
+        }
+
+    def close(self):
+        self.capture.release()
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.output_file_csv is not None:
+            self.output_file_csv.close()
+        if self.output_container is not None:
+            self.output_container.close()
+
+class MultiCamera:
+    def __init__(self, sources, workers=None, queue_depth=1):
+        self.cameras = [Camera(i, source, queue_depth) for i, source in enumerate(sources)]
+        self.workers = workers if workers is not None else min(len(self.cameras), os.cpu_count() or 1)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        self.actuators = list(aruco_core.ACTUATORS)
+        self.calibrate = False
+        self.calibration_cache = None
+        self.display = True
+        self.display_rate = 15
+        self.display_time = 0
+        self.stats_period = 5.0
+        self.stats_time = time.monotonic()
+        self.running = True
+
+    def setOutput(self, directory, recording_format="png"):
+        for camera in self.cameras:
+            camera.setOutput(f"{directory}/{camera.name}", recording_format, self.actuators)
+
+    def inFlight(self):
+        return sum(1 for camera in self.cameras if camera.future is not None)
+
+    def run(self):
+        # One scheduling round. Finished frames are collected first, then every
+        # free worker goes to the least recently served camera with a new frame.
+        # A camera only gets a new frame once its previous one is finished.
+        progressed = False
+        for camera in self.cameras:
+            if camera.future is not None and camera.future.done():
+                self.__collect(camera)
+                progressed = True
+        ready = []
+        for camera in self.cameras:
+            if camera.future is not None or not camera.active:
+                continue
+            if camera.capture.queueDepth() > 0:
+                ready.append(camera)
+            elif camera.capture.finished():
+                camera.active = False
+                print(f"{camera.name} ({camera.source}) stopped")
+        ready.sort(key=lambda camera: camera.submitted)
+        for camera in ready[:self.workers - self.inFlight()]:
+            success, frame = camera.capture.poll()
+            if success and frame is not None:
+                self.__submit(camera, frame)
+                progressed = True
+        if not any(camera.active or camera.future is not None for camera in self.cameras):
+            self.running = False
+        if self.display:
+            self.__drawWindows()
+        if time.monotonic() - self.stats_time >= self.stats_period:
+            self.printStats()
+            self.stats_time = time.monotonic()
+        if not progressed:
+            time.sleep(0.001)
+
+    def __submit(self, camera, frame):
+        if not camera.calibration_loaded and self.calibration_cache is not None:
+            camera.matrix = self.calibration_cache.load(str(camera.source), frame.shape)
+            if camera.matrix is not None:
+                print(f"Loaded calibration for {camera.source}")
+        camera.calibration_loaded = True
+        camera.frame = frame
+        camera.timestamp = camera.capture.timestamp
+        camera.submitted = time.clock_gettime(time.CLOCK_REALTIME)
+        camera.waits.append(camera.submitted - camera.timestamp)
+        camera.future = self.executor.submit(detect, frame, camera.matrix, self.actuators, self.calibrate)
+
+    def __collect(self, camera):
+        matrix, camera.results = camera.future.result()
+        camera.future = None
+        camera.latencies.append(time.clock_gettime(time.CLOCK_REALTIME) - camera.timestamp)
+        camera.processed_frames += 1
+        camera.window_frames += 1
+        if matrix is not None and camera.matrix is None:
+            camera.matrix = matrix
+            if self.calibration_cache is not None:
+                self.calibration_cache.save(str(camera.source), camera.frame.shape, matrix)
+        if camera.recorder is not None:
+            camera.record()
+
+    def __drawWindows(self):
+        now = time.monotonic()
+        if self.display_rate > 0 and now - self.display_time < 1/self.display_rate:
+            return
+        self.display_time = now
+        for camera in self.cameras:
+            if camera.frame is None:
+                continue
+            image = camera.frame.copy()
+            angles = []
+            for markers, angle in camera.results:
+                angles.append(str(angle))
+                # calibrated points are in the transformed plane
+                if len(markers) != 3 or camera.matrix is not None:
+                    continue
+                cv2.line(image, markers[2], markers[0], (0, 0, 0), 4)
+                cv2.line(image, markers[2], markers[1], (0, 0, 0), 4)
+            cv2.putText(image, f"Angle: {', '.join(angles)}", (10, image.shape[0]-15),
+                        cv2.FONT_HERSHEY_DUPLEX, 1, (0, 0, 255), 1, 2)
+            cv2.imshow(f"{camera.name} - {camera.source}", image)
+        if cv2.pollKey() == 8: # backspace - close
+            self.running = False
+
+    def fairness(self):
+        # Jain's index of the share of captured frames each camera got
+        # processed, 1 when all cameras are served equally
+        served = numpy.float64([camera.stats()["served"] for camera in self.cameras])
+        if not numpy.any(served > 0):
+            return 1.0
+        return float(served.sum()**2 / (len(served) * (served**2).sum()))
+
+    def printStats(self):
+        elapsed = max(time.monotonic() - self.stats_time, 1e-9)
+        for camera in self.cameras:
+            stats = camera.stats()
+            print(f"{camera.name}: {camera.window_frames/elapsed:.1f} fps, processed {stats['processed']} of {stats['captured']} ({100*stats['served']:.0f}%), "
+                  f"latency {stats['latency_p50_ms']:.1f}/{stats['latency_p99_ms']:.1f} ms p50/p99, wait {stats['wait_p50_ms']:.1f} ms")
+            camera.window_frames = 0
+        print(f"Fairness {self.fairness():.3f}, {self.workers} workers")
+
+    def close(self):
+        self.printStats()
+        for camera in self.cameras:
+            if camera.future is not None:
+                camera.future.cancel()
+        self.executor.shutdown(wait=True)
+        for camera in self.cameras:
+            camera.close()
+        if self.display:
+            for camera in self.cameras:
+                cv2.destroyWindow(f"{camera.name} - {camera.source}")
+
+def parseSource(source):
+    try:
+        return int(source)
+    except ValueError:
+        return source
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Measure the actuators of several cameras in one process")
+    parser.add_argument("-c", "--camera", action='append', required=True, help = "Camera path, repeated for every camera")
+    parser.add_argument("-o", "--output", action='store', help = "Output directory, one recording per camera is created inside")
+    parser.add_argument("-f", "--format", action='store', choices = ["png", "container"], help = "Recording format")
+    parser.add_argument("-j", "--jobs", action='store', help = "Number of detection worker threads shared by all cameras")
+    parser.add_argument("-q", "--queue-depth", action='store', help = "Number of frames kept by every capture thread")
+    parser.add_argument("--actuators", action='store', help = "Comma separated TIP_ID/VERTEX_ID marker pairs, one per actuator")
+    parser.add_argument("--calibrate", action='store_true', help = "Detect the calibration markers until every camera is calibrated")
+    parser.add_argument("--calibration-cache", action='store', help = "File where perspective calibrations are stored")
+    parser.add_argument("--no-calibration-cache", action='store_true', help = "Do not load or store perspective calibrations")
+    parser.add_argument("--no-display", action='store_true', help = "Do not open a window per camera")
+    parser.add_argument("--display-rate", action='store', help = "Maximum number of window refreshes per second")
+    parser.add_argument("--stats-period", action='store', help = "Seconds between the statistics lines")
+    args = parser.parse_args()
+
+    cameras = MultiCamera([parseSource(c) for c in args.camera],
+        int(args.jobs) if args.jobs != None else None,
+        int(args.queue_depth) if args.queue_depth != None else 1)
+    if args.actuators != None:
+        cameras.actuators = aruco_core.parseActuators(args.actuators)
+    cameras.calibrate = args.calibrate
+    if not args.no_calibration_cache:
+        path = args.calibration_cache if args.calibration_cache != None else os.path.expanduser("~/.actuator_calibration.json")
+        cameras.calibration_cache = calibration.CalibrationCache(path)
+    cameras.display = not args.no_display
+    if args.display_rate != None:
+        cameras.display_rate = float(args.display_rate)
+    if args.stats_period != None:
+        cameras.stats_period = float(args.stats_period)
+    if args.output != None:
+        cameras.setOutput(args.output, args.format if args.format != None else "png")
+    try:
+        while cameras.running:
+            cameras.run()
+    except KeyboardInterrupt:
+        pass
+    cameras.close()
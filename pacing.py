@@ -0,0 +1,98 @@
+import collections
+import numpy
+import time
+
+class PacingScheduler:
+    # Paces a loop to a fixed rate. Iteration k is due at start + k*period on
+    # the monotonic clock, so the processing time does not add up as with a
+    # sleep after every iteration. When an iteration overruns its deadline:
+    #   skip: the deadlines which have passed are skipped and the loop waits
+    #         for the next one, so the iterations stay on the grid
+    #   late: the next iteration runs immediately and the following ones catch
+    #         up with the grid, so no iteration is left out
+    # Without a rate, every iteration gives its own deadline to waitUntil().
+    POLICIES = ("skip", "late")
+
+    def __init__(self, rate=None, policy="skip"):
+        if policy not in PacingScheduler.POLICIES:
+            raise ValueError(f"Unknown pacing policy '{policy}', expected one of {PacingScheduler.POLICIES}")
+        self.period = 1 / rate if rate is not None else None
+        self.policy = policy
+        self.start = None
+        self.first = None
+        self.index = 0
+        self.iterations = 0
+        self.missed_deadlines = 0
+        self.skipped_deadlines = 0
+        self.lateness = collections.deque(maxlen=10000)
+
+    def wait(self):
+        # Called before every iteration. Sleeps until it is due and returns the
+        # number of skipped deadlines.
+        now = time.monotonic()
+        self.iterations += 1
+        if self.start is None:
+            self.start = now
+            self.first = self.first if self.first is not None else now
+            return 0
+        self.index += 1
+        deadline = self.start + self.index*self.period
+        skipped = 0
+        if now > deadline:
+            self.missed_deadlines += 1
+            if self.policy == "late":
+                self.lateness.append(now - deadline)
+                return 0
+            skipped = int((now - deadline) / self.period) + 1
+            self.index += skipped
+            self.skipped_deadlines += skipped
+            deadline += skipped*self.period
+        remaining = deadline - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
+        self.lateness.append(time.monotonic() - deadline)
+        return skipped
+
+    def waitUntil(self, offset):
+        # Sleeps until offset seconds after the start, which is the first call
+        # after restart(). Returns the lateness in seconds.
+        now = time.monotonic()
+        self.iterations += 1
+        if self.start is None:
+            self.start = now - offset
+            self.first = self.first if self.first is not None else now
+            return 0.0
+        deadline = self.start + offset
+        if now > deadline:
+            self.missed_deadlines += 1
+        else:
+            time.sleep(deadline - now)
+        lateness = max(time.monotonic() - deadline, 0.0)
+        self.lateness.append(lateness)
+        return lateness
+
+    def due(self, offset):
+        return self.start is not None and time.monotonic() >= self.start + offset
+
+    def skip(self, count=1):
+        # Counts iterations the caller left out because they were overdue
+        self.skipped_deadlines += count
+
+    def restart(self):
+        # The next wait starts a new schedule, the statistics are kept
+        self.start = None
+        self.index = 0
+
+    def stats(self):
+        elapsed = time.monotonic() - self.first if self.first is not None else 0
+        lateness = numpy.float64(self.lateness) * 1000
+        return {
+            "iterations": self.iterations,
+            "rate": (self.iterations - 1) / elapsed if elapsed > 0 else 0.0,
+            "target_rate": 1 / self.period if self.period is not None else numpy.nan,
+            "missed": self.missed_deadlines,
+            "skipped": self.skipped_deadlines,
+            "jitter_p50_ms": numpy.percentile(lateness, 50) if len(lateness) else numpy.nan,
+            "jitter_p99_ms": numpy.percentile(lateness, 99) if len(lateness) else numpy.nan,
+            "jitter_max_ms": lateness.max() if len(lateness) else numpy.nan,
+        }
@@ -0,0 +1,246 @@
+import cv2
+import argparse
+import csv
+import heapq
+import multiprocessing
+import os
+import signal
+import time
+import aruco_core
+import calibration
+import container
+from frame_ring import FrameRing
+from multicamera import parseSource, windowId
+from publisher import AnglePublisher
+
+# One camera measured by several processes, so detection and recording are not
+# limited to one core by the GIL. The capture process decodes every frame
+# straight into a shared memory ring (frame_ring.FrameRing). Detection
+# processes take the newest frame of their share of the sequence numbers and
+# read it without copying. The recording process encodes the detected frames
+# from the ring in capture order. A frame overwritten by the capture while it
+# is detected or recorded is dropped.
+
+COUNTERS = ["detected", "skipped", "overwritten", "recorded", "record_dropped"]
+
+def captureFrames(source, ring, stop):
+    # Ctrl+C is handled by the main process, which stops the capture. The
+    # other processes finish with the frames already captured.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    video_capture = cv2.VideoCapture(source)
+    while not stop.is_set():
+        sequence, view = ring.beginWrite()
+        success, frame = video_capture.read(view)
+        if not success:
+            break
+        if frame is not view:
+            if frame.shape != view.shape:
+                print(f"Frame size of {source} changed to {frame.shape}, stopping")
+                break
+            view[:] = frame
+        ring.endWrite(sequence, time.clock_gettime(time.CLOCK_REALTIME))
+    ring.finish()
+    video_capture.release()
+
+def detectFrames(ring, worker, workers, actuators, matrix, results, counters, publish_address):
+    # Worker i takes the frames whose number modulo workers is i, always the
+    # newest one, so the workers never wait for each other
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    detector = aruco_core.createDetector()
+    publisher = AnglePublisher(publish_address) if publish_address is not None else None
+    last = worker - workers
+    while True:
+        latest = ring.latest()
+        sequence = latest - (latest - worker) % workers
+        if sequence <= last:
+            if ring.finished() and ring.latest() == latest:
+                break
+            time.sleep(0.0005)
+            continue
+        skipped = (sequence - last) // workers - 1
+        last = sequence
+        timestamp, frame = ring.read(sequence)
+        if frame is not None:
+            output = aruco_core.processActuators(detector, frame, actuators, matrix)
+        if frame is None or not ring.valid(sequence):
+            increment(counters, "overwritten")
+            continue
+        increment(counters, "detected")
+        increment(counters, "skipped", skipped)
+        if publisher is not None:
+            for i, (markers, angle) in enumerate(output):
+                publisher.publish(i, True, sequence, timestamp, angle, markers)
+        if results is not None:
+            results.put((worker, sequence, timestamp, output))
+    if results is not None:
+        results.put((worker, None, None, None))
+    if publisher is not None:
+        publisher.close()
+
+def recordFrames(ring, directory, recording_format, actuators, matrix, results, workers, counters):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    os.makedirs(directory, exist_ok=True)
+    template = directory + '/' + directory[directory.rfind('/')+1 :]
+    output_file_csv = None
+    output_container = None
+    if recording_format == "container":
+        output_container = container.ContainerWriter(template)
+        encode = output_container.encode
+        commit = output_container.commit
+    else:
+        output_file_csv = open(template+".csv", mode="w")
+        writer = csv.writer(output_file_csv)
+        writer.writerow(container.recordingHead(len(actuators)))
+        encode = lambda name, frame: cv2.imencode(".png", frame)[1].tobytes()
+        def commit(row, encoded):
+            if len(encoded) > 0:
+                with open(row[8], mode="wb") as file:
+                    file.write(encoded[0])
+            writer.writerow(row)
+    commit(calibration.calibrationRow(matrix), [])
+
+    # The results of the workers arrive out of order. A frame is written once
+    # every worker has delivered a later one, since every worker delivers its
+    # frames in order.
+    pending = []
+    delivered = [-1]*workers
+    while min(delivered) < float("inf"):
+        worker, sequence, timestamp, output = results.get()
+        if sequence is None:
+            delivered[worker] = float("inf")
+        else:
+            delivered[worker] = sequence
+            heapq.heappush(pending, (sequence, timestamp, output))
+        while pending and pending[0][0] <= min(delivered):
+            sequence, timestamp, output = heapq.heappop(pending)
+            _, frame = ring.read(sequence)
+            if frame is None:
+                increment(counters, "record_dropped")
+                continue
+            name = f"{template}_orig_{windowId(timestamp)}.png"
+            encoded = encode(name, frame)
+            if not ring.valid(sequence):
+                increment(counters, "record_dropped")
+                continue
+            columns = [container.actuatorColumns(markers, angle) for markers, angle in output]
+            row = columns[0] + [name, "", 1]
+            for group in columns[1:]:
+                row += group
+            commit(row, [encoded])
+            increment(counters, "recorded")
+    if output_file_csv is not None:
+        output_file_csv.close()
+    if output_container is not None:
+        output_container.close()
+
+def increment(counters, name, value=1):
+    counter = counters[name]
+    with counter.get_lock():
+        counter.value += value
+
+class Pipeline:
+    def __init__(self, source, slots=8, workers=2):
+        self.source = source
+        self.workers = max(1, int(workers))
+        self.actuators = list(aruco_core.ACTUATORS)
+        self.matrix = None
+        self.calibration_cache = None
+        self.output_dir = None
+        self.recording_format = "png"
+        self.publish_address = None
+        self.stats_period = 5.0
+        # The frame size is needed for the ring before the capture process
+        # starts, so the source is opened once here
+        video_capture = cv2.VideoCapture(source)
+        success, frame = video_capture.read()
+        video_capture.release()
+        if not success:
+            raise RuntimeError(f"Could not read a frame from {source}")
+        self.ring = FrameRing(frame.shape, slots)
+        self.counters = {name: multiprocessing.Value('q', 0) for name in COUNTERS}
+        self.stop = multiprocessing.Event()
+        self.processes = []
+
+    def start(self):
+        if self.calibration_cache is not None:
+            self.matrix = self.calibration_cache.load(str(self.source), self.ring.shape)
+            if self.matrix is not None:
+                print(f"Loaded calibration for {self.source}")
+        results = multiprocessing.Queue() if self.output_dir is not None else None
+        self.processes.append(multiprocessing.Process(target=captureFrames, args=(self.source, self.ring, self.stop), name="capture"))
+        for worker in range(self.workers):
+            self.processes.append(multiprocessing.Process(target=detectFrames, name=f"detection{worker}",
+                args=(self.ring, worker, self.workers, self.actuators, self.matrix, results, self.counters, self.publish_address)))
+        if results is not None:
+            self.processes.append(multiprocessing.Process(target=recordFrames, name="recording",
+                args=(self.ring, self.output_dir, self.recording_format, self.actuators, self.matrix, results, self.workers, self.counters)))
+        for process in self.processes:
+            process.start()
+        self.start_time = time.monotonic()
+
+    def running(self):
+        return any(process.is_alive() for process in self.processes)
+
+    def stats(self):
+        stats = {name: counter.value for name, counter in self.counters.items()}
+        stats["captured"] = self.ring.written()
+        return stats
+
+    def printStats(self):
+        stats = self.stats()
+        elapsed = max(time.monotonic() - self.start_time, 1e-9)
+        line = (f"Captured {stats['captured']} ({stats['captured']/elapsed:.1f} fps), detected {stats['detected']} ({stats['detected']/elapsed:.1f} fps), "
+                f"skipped {stats['skipped']}, overwritten {stats['overwritten']}")
+        if self.output_dir is not None:
+            line += f", recorded {stats['recorded']}, dropped {stats['record_dropped']}"
+        print(line)
+
+    def run(self):
+        next_stats = time.monotonic() + self.stats_period
+        try:
+            while self.running():
+                time.sleep(0.05)
+                if time.monotonic() >= next_stats:
+                    self.printStats()
+                    next_stats += self.stats_period
+        except KeyboardInterrupt:
+            pass
+        self.close()
+
+    def close(self):
+        self.stop.set()
+        for process in self.processes:
+            process.join()
+        self.printStats()
+        self.ring.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Measure one camera with separate capture, detection and recording processes")
+    parser.add_argument("-c", "--camera", action='store', required=True, help = "Camera path")
+    parser.add_argument("-o", "--output", action='store', help = "Output file path")
+    parser.add_argument("-f", "--format", action='store', choices = ["png", "container"], help = "Recording format")
+    parser.add_argument("-j", "--jobs", action='store', help = "Number of detection processes")
+    parser.add_argument("-s", "--slots", action='store', help = "Number of frames kept in shared memory")
+    parser.add_argument("--actuators", action='store', help = "Comma separated TIP_ID/VERTEX_ID marker pairs, one per actuator")
+    parser.add_argument("--calibration-cache", action='store', help = "File where perspective calibrations are stored")
+    parser.add_argument("--no-calibration-cache", action='store_true', help = "Do not load perspective calibrations")
+    parser.add_argument("--publish", action='store', help = "Send the angles of every frame to udp://HOST:PORT or unix://PATH")
+    parser.add_argument("--stats-period", action='store', help = "Seconds between the statistics lines")
+    args = parser.parse_args()
+
+    pipeline = Pipeline(parseSource(args.camera),
+        int(args.slots) if args.slots != None else 8,
+        int(args.jobs) if args.jobs != None else 2)
+    if args.actuators != None:
+        pipeline.actuators = aruco_core.parseActuators(args.actuators)
+    if not args.no_calibration_cache:
+        path = args.calibration_cache if args.calibration_cache != None else os.path.expanduser("~/.actuator_calibration.json")
+        pipeline.calibration_cache = calibration.CalibrationCache(path)
+    if args.output != None:
+        pipeline.output_dir = args.output
+        pipeline.recording_format = args.format if args.format != None else "png"
+    pipeline.publish_address = args.publish
+    if args.stats_period != None:
+        pipeline.stats_period = float(args.stats_period)
+    pipeline.start()
+    pipeline.run()
@@ -0,0 +1,91 @@
+import numpy
+
+class MarkerPredictor:
+    # Constant velocity Kalman filter over the three marker centers, with every
+    # coordinate filtered independently and a time step of one frame. The
+    # process noise is scaled by the recent normalized innovations, so the
+    # uncertainty grows faster while the actuator moves unexpectedly and a
+    # measurement is requested sooner.
+    def __init__(self, interval=4, threshold=2.0, process_noise=0.05, measurement_noise=1.0):
+        self.interval = interval # maximum number of predicted frames in a row
+        self.threshold = threshold # pixels
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.measured = 0
+        self.predicted = 0
+        self.reset()
+
+    def reset(self):
+        self.position = None
+        self.velocity = None
+        self.variance = None # position variance, covariance, velocity variance
+        self.scale = 1.0
+        self.updates = 0
+        self.age = 0
+
+    def advance(self):
+        # Moves the state to the next frame
+        if self.position is None:
+            return
+        p00, p01, p11 = self.variance
+        q = self.process_noise * self.scale
+        self.position = self.position + self.velocity
+        self.variance = (p00 + 2*p01 + p11 + q/4, p01 + p11 + q/2, p11 + q)
+        self.age += 1
+
+    def uncertainty(self):
+        if self.position is None:
+            return numpy.inf
+        return float(numpy.sqrt(self.variance[0].max()))
+
+    def shouldMeasure(self):
+        return (self.updates < 2 or self.age > self.interval
+                or self.uncertainty() > self.threshold)
+
+    def update(self, markers):
+        # Takes the detected centers (tips first, vertex last) and returns them
+        # with the tips in the order the filter tracks them
+        z = numpy.float64(markers).flatten()
+        self.measured += 1
+        if self.position is None:
+            self.position = z
+            self.velocity = numpy.zeros_like(z)
+            self.variance = (numpy.full_like(z, self.measurement_noise), numpy.zeros_like(z), numpy.full_like(z, 100.0))
+            self.updates = 1
+            self.age = 0
+            return markers
+        # Both tips have the same id, so their detection order is arbitrary
+        swapped = numpy.concatenate((z[2:4], z[0:2], z[4:6]))
+        if numpy.sum((swapped - self.position)**2) < numpy.sum((z - self.position)**2):
+            z = swapped
+            markers = [markers[1], markers[0], markers[2]]
+        p00, p01, p11 = self.variance
+        innovation = z - self.position
+        s = p00 + self.measurement_noise
+        k0 = p00 / s
+        k1 = p01 / s
+        self.position = self.position + k0*innovation
+        self.velocity = self.velocity + k1*innovation
+        self.variance = ((1 - k0)*p00, (1 - k0)*p01, p11 - k1*p01)
+        if self.updates >= 2:
+            normalized = float(numpy.max(innovation**2 / s))
+            self.scale = max(1.0, 0.5*self.scale + 0.5*normalized)
+        self.updates += 1
+        self.age = 0
+        return markers
+
+    def predict(self, precise=False):
+        # Returns the predicted centers, as integer points unless precise is set
+        self.predicted += 1
+        if precise:
+            return [[round(float(x), 2), round(float(y), 2)] for x, y in self.position.reshape(3, 2)]
+        return [[int(round(x)), int(round(y))] for x, y in self.position.reshape(3, 2)]
+
+    def stats(self):
+        total = self.measured + self.predicted
+        return {
+            "measured": self.measured,
+            "predicted": self.predicted,
+            "predicted_ratio": self.predicted / total if total > 0 else 0.0,
+            "uncertainty": self.uncertainty(),
+        }
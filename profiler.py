@@ -0,0 +1,120 @@
+import numpy
+import os
+import time
+
+class NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+NULL_STAGE = NullStage()
+
+class Stage:
+    def __init__(self, times, index):
+        self.times = times
+        self.index = index
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        elapsed = time.perf_counter() - self.start
+        if numpy.isnan(self.times[self.index]):
+            self.times[self.index] = elapsed
+        else:
+            self.times[self.index] += elapsed
+        return False
+
+class StageProfiler:
+    # Times named stages of every frame. When disabled, stage() returns a
+    # shared no-op context manager and the frame calls return immediately.
+    # The histograms have 10 logarithmic bins per decade from 1 us to 10 s and
+    # are reset after every summary line.
+    EDGES = numpy.logspace(-3, 4, 71) # milliseconds
+
+    def __init__(self, stages, period=5.0, output_path=None):
+        self.names = list(stages) + ["total"]
+        self.period = period
+        self.output_path = output_path
+        self.output_file = None
+        self.enabled = False
+        self.times = numpy.full(len(self.names), numpy.nan)
+        self.stages = {name: Stage(self.times, i) for i, name in enumerate(self.names)}
+        self.histograms = numpy.zeros((len(self.names), len(StageProfiler.EDGES)+1), dtype=numpy.int64)
+        self.frame_number = 0
+        self.window_frames = 0
+        self.window_start = time.perf_counter()
+        self.frame_start = 0
+
+    def setEnabled(self, enabled):
+        if enabled == self.enabled:
+            return
+        self.enabled = enabled
+        if enabled:
+            self.histograms[:] = 0
+            self.window_frames = 0
+            self.window_start = time.perf_counter()
+            if self.output_path is not None and self.output_file is None:
+                new_file = not os.path.isfile(self.output_path)
+                self.output_file = open(self.output_path, mode="a")
+                if new_file:
+                    self.output_file.write(",".join(["frame", "timestamp"] + [f"{name}_ms" for name in self.names]) + "\n")
+        print(f"Profiling {'enabled' if enabled else 'disabled'}")
+
+    def toggle(self):
+        self.setEnabled(not self.enabled)
+
+    def stage(self, name):
+        if not self.enabled:
+            return NULL_STAGE
+        return self.stages[name]
+
+    def beginFrame(self):
+        if not self.enabled:
+            return
+        self.times[:] = numpy.nan
+        self.frame_start = time.perf_counter()
+
+    def endFrame(self):
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self.times[-1] = now - self.frame_start
+        milliseconds = self.times * 1000
+        ran = ~numpy.isnan(milliseconds)
+        bins = numpy.searchsorted(StageProfiler.EDGES, milliseconds[ran])
+        self.histograms[numpy.flatnonzero(ran), bins] += 1
+        self.frame_number += 1
+        self.window_frames += 1
+        if self.output_file is not None:
+            values = ["" if numpy.isnan(m) else f"{m:.3f}" for m in milliseconds]
+            self.output_file.write(",".join([str(self.frame_number), f"{time.time():.6f}"] + values) + "\n")
+        if now - self.window_start >= self.period:
+            print(self.summary(now - self.window_start))
+            self.histograms[:] = 0
+            self.window_frames = 0
+            self.window_start = now
+
+    def percentile(self, name, q):
+        histogram = self.histograms[self.names.index(name)]
+        total = histogram.sum()
+        if total == 0:
+            return numpy.nan
+        index = numpy.searchsorted(numpy.cumsum(histogram), q*total)
+        return StageProfiler.EDGES[min(index, len(StageProfiler.EDGES)-1)]
+
+    def summary(self, elapsed):
+        parts = [f"{self.window_frames/max(elapsed, 1e-9):.1f} fps"]
+        for name in self.names:
+            if self.histograms[self.names.index(name)].sum() > 0:
+                parts.append(f"{name} {self.percentile(name, 0.5):.2g}/{self.percentile(name, 0.99):.2g}")
+        return "Profile (p50/p99 ms): " + ", ".join(parts)
+
+    def close(self):
+        if self.output_file is not None:
+            self.output_file.close()
+            self.output_file = None
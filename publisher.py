@@ -0,0 +1,109 @@
+import argparse
+import collections
+import os
+import select
+import socket
+import struct
+import time
+
+# Every processed frame is sent as one datagram per actuator, over UDP or a
+# Unix domain datagram socket, without touching the disk:
+#   magic, version, actuator, flags, frame id, capture timestamp, angle, points
+# Sending never blocks. When the subscriber is not running or its buffer is
+# full, the message is dropped and counted.
+MAGIC = b"ACTA"
+VERSION = 1
+MESSAGE_FORMAT = "<4sBBBxQdf6f"
+MESSAGE_SIZE = struct.calcsize(MESSAGE_FORMAT)
+FLAG_MEASURED = 0x01
+
+Message = collections.namedtuple("Message", ["actuator", "measured", "frame", "timestamp", "angle", "points"])
+
+def parseAddress(address):
+    # "udp://host:port" or "unix:///path/to/socket"
+    if address.startswith("udp://"):
+        host, port = address[len("udp://"):].rsplit(':', 1)
+        return socket.AF_INET, (host, int(port))
+    if address.startswith("unix://"):
+        return socket.AF_UNIX, address[len("unix://"):]
+    raise ValueError(f"Unknown address '{address}', expected udp://HOST:PORT or unix://PATH")
+
+def pack(actuator, measured, frame, timestamp, angle, markers):
+    points = [float(value) for point in markers for value in point]
+    if len(points) != 6:
+        points = [-1.0]*6
+    return struct.pack(MESSAGE_FORMAT, MAGIC, VERSION, actuator, FLAG_MEASURED if measured else 0,
+                       frame, timestamp, float(angle), *points)
+
+def unpack(data):
+    if len(data) != MESSAGE_SIZE:
+        return None
+    magic, version, actuator, flags, frame, timestamp, angle, *points = struct.unpack(MESSAGE_FORMAT, data)
+    if magic != MAGIC or version != VERSION:
+        return None
+    return Message(actuator, bool(flags & FLAG_MEASURED), frame, timestamp, angle,
+                   [points[0:2], points[2:4], points[4:6]])
+
+class AnglePublisher:
+    def __init__(self, address):
+        self.family, self.address = parseAddress(address)
+        self.socket = socket.socket(self.family, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.sent_messages = 0
+        self.dropped_messages = 0
+
+    def publish(self, actuator, measured, frame, timestamp, angle, markers):
+        try:
+            self.socket.sendto(pack(actuator, measured, frame, timestamp, angle, markers), self.address)
+            self.sent_messages += 1
+            return True
+        except OSError:
+            # no subscriber, or its receive buffer is full
+            self.dropped_messages += 1
+            return False
+
+    def stats(self):
+        return {"sent": self.sent_messages, "dropped": self.dropped_messages}
+
+    def close(self):
+        self.socket.close()
+
+class AngleSubscriber:
+    def __init__(self, address):
+        self.family, self.address = parseAddress(address)
+        self.socket = socket.socket(self.family, socket.SOCK_DGRAM)
+        if self.family == socket.AF_UNIX and os.path.exists(self.address):
+            os.remove(self.address)
+        self.socket.bind(self.address)
+
+    def receive(self, timeout=None):
+        # Returns the next message, or None when the timeout expires
+        while True:
+            if timeout is not None and not select.select([self.socket], [], [], timeout)[0]:
+                return None
+            message = unpack(self.socket.recv(MESSAGE_SIZE + 1))
+            if message is not None:
+                return message
+
+    def close(self):
+        self.socket.close()
+        if self.family == socket.AF_UNIX and os.path.exists(self.address):
+            os.remove(self.address)
+
+if __name__ == "__main__":
+    # Reference subscriber: prints every message with its delivery latency
+    parser = argparse.ArgumentParser(description = "Receive the angles published by actuator_aruco.py --publish")
+    parser.add_argument("address", help = "udp://HOST:PORT or unix://PATH, the same as given to --publish")
+    args = parser.parse_args()
+
+    subscriber = AngleSubscriber(args.address)
+    print("frame,actuator,measured,angle,x1,y1,x2,y2,x3,y3,latency_ms")
+    try:
+        while True:
+            message = subscriber.receive()
+            latency = (time.clock_gettime(time.CLOCK_REALTIME) - message.timestamp) * 1000
+            points = ",".join(f"{value:g}" for point in message.points for value in point)
+            print(f"{message.frame},{message.actuator},{int(message.measured)},{message.angle:g},{points},{latency:.3f}", flush=True)
+    except KeyboardInterrupt:
+        pass
+    subscriber.close()
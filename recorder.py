@@ -0,0 +1,113 @@
+import collections
+import concurrent.futures
+import queue
+import threading
+import time
+
+class AsyncRecorder:
+    # Encodes frames on a bounded worker pool and commits rows in submission
+    # order on a single writer thread.
+    #   encode(name, frame) runs on a worker and returns whatever commit needs
+    #   commit(row, results) runs in frame order with the encode results
+    POLICIES = ("block", "drop")
+
+    def __init__(self, encode, commit, workers=2, queue_size=8, policy="block"):
+        if policy not in AsyncRecorder.POLICIES:
+            raise ValueError(f"Unknown recording policy '{policy}', expected one of {AsyncRecorder.POLICIES}")
+        self.encode = encode
+        self.commit = commit
+        self.policy = policy
+        self.queue_size = max(1, int(queue_size))
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, int(workers)))
+        self.slots = threading.Semaphore(self.queue_size)
+        self.pending = queue.Queue()
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.submitted_frames = 0
+        self.written_frames = 0
+        self.dropped_frames = 0
+        self.encode_times = collections.deque(maxlen=1000)
+        self.error = None
+        self.closed = False
+        self.writer = threading.Thread(target=self.__commitLoop, daemon=True)
+        self.writer.start()
+
+    def submit(self, row, images=()):
+        if self.closed:
+            raise RuntimeError("Recorder is closed")
+        if self.policy == "drop" and len(images) > 0:
+            if not self.slots.acquire(blocking=False):
+                with self.lock:
+                    self.dropped_frames += 1
+                return False
+        else:
+            self.slots.acquire()
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            if len(images) > 0:
+                self.submitted_frames += 1
+        futures = [self.executor.submit(self.__encode, name, frame) for name, frame in images]
+        self.pending.put((row, futures))
+        return True
+
+    def writeRow(self, row):
+        return self.submit(row)
+
+    def __encode(self, name, frame):
+        start = time.perf_counter()
+        result = self.encode(name, frame)
+        return result, time.perf_counter() - start
+
+    def __commitLoop(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            row, futures = item
+            try:
+                results = []
+                encode_time = 0
+                for future in futures:
+                    result, duration = future.result()
+                    results.append(result)
+                    encode_time += duration
+                self.commit(row, results)
+                with self.lock:
+                    if len(futures) > 0:
+                        self.written_frames += 1
+                        self.encode_times.append(encode_time)
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
+                    print(f"Recording error: {e}")
+            finally:
+                with self.lock:
+                    self.in_flight -= 1
+                self.slots.release()
+
+    def queueDepth(self):
+        with self.lock:
+            return self.in_flight
+
+    def stats(self):
+        with self.lock:
+            times = sorted(self.encode_times)
+            return {
+                "submitted": self.submitted_frames,
+                "written": self.written_frames,
+                "dropped": self.dropped_frames,
+                "queue_depth": self.in_flight,
+                "max_queue_depth": self.max_in_flight,
+                "encode_ms_mean": 1000*sum(times)/len(times) if times else 0,
+                "encode_ms_max": 1000*times[-1] if times else 0,
+            }
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.pending.put(None)
+        self.writer.join()
+        self.executor.shutdown(wait=True)
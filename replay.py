@@ -0,0 +1,174 @@
+import cv2
+import collections
+import concurrent.futures
+import csv
+import os
+import threading
+import container
+import calibration
+
+def recordingTemplate(path):
+    path = path.rstrip('/')
+    return path + '/' + path[path.rfind('/')+1 :]
+
+class Recording:
+    def __init__(self, path):
+        self.path = path
+        self.template = recordingTemplate(path)
+        self.is_container = container.isContainer(self.template)
+        self.reader = None
+        self.reader_lock = threading.Lock()
+
+    # Yields ("frame", key), ("calibration", matrix or None) and ("toggle", None)
+    # for C key presses without a stored matrix, in recording order. The key is
+    # the image path for CSV recordings and the record index for container
+    # recordings.
+    def events(self):
+        if self.is_container:
+            reader = container.ContainerReader(self.template)
+            for i in range(len(reader)):
+                kind = reader.record(i)["kind"]
+                if kind == container.KIND_FRAME:
+                    yield "frame", i
+                    continue
+                if kind == container.KIND_ACTUATOR:
+                    continue
+                matrix = reader.readCalibration(i)
+                if isinstance(matrix, str):
+                    yield "toggle", None
+                else:
+                    yield "calibration", matrix
+            reader.close()
+            return
+        with open(self.template+".csv", mode="r") as input_file_csv:
+            input_reader = csv.reader(input_file_csv)
+            next(input_reader)
+            for data in input_reader:
+                if data == [container.CALIBRATION_COMMENT]:
+                    yield "toggle", None
+                elif len(data) > 0 and data[0] == calibration.CALIBRATION_ROW:
+                    yield "calibration", calibration.parseCalibrationRow(data)
+                elif len(data) >= 10:
+                    yield "frame", data[8]
+
+    def keyName(self, key):
+        if self.is_container:
+            return f"{self.template}.idx#{key}"
+        return key
+
+    # The container reader is opened by the first thread which needs it
+    def __reader(self):
+        with self.reader_lock:
+            if self.reader is None:
+                self.reader = container.ContainerReader(self.template)
+            return self.reader
+
+    # Capture time of a frame in seconds, 0 if it is unknown
+    def frameTimestamp(self, key):
+        if self.is_container:
+            return float(self.__reader().record(key)["timestamp"])
+        return container.windowTimestamp(key)
+
+    # Thread-safe, returns None for missing frames
+    def readFrame(self, key):
+        if self.is_container:
+            return self.__reader().readFrame(key)
+        if not os.path.isfile(key):
+            return None
+        return cv2.imread(key)
+
+    def close(self):
+        with self.reader_lock:
+            if self.reader is not None:
+                self.reader.close()
+                self.reader = None
+
+class FrameCache:
+    # Least recently used decoded frames, limited by their total size in bytes
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        self.frames = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            frame = self.frames.get(key)
+            if frame is None:
+                self.misses += 1
+                return None
+            self.frames.move_to_end(key)
+            self.hits += 1
+            return frame
+
+    def contains(self, key):
+        with self.lock:
+            return key in self.frames
+
+    def put(self, key, frame):
+        if frame is None or frame.nbytes > self.budget:
+            return
+        with self.lock:
+            if key in self.frames:
+                return
+            self.frames[key] = frame
+            self.size += frame.nbytes
+            while self.size > self.budget:
+                _, evicted = self.frames.popitem(last=False)
+                self.size -= evicted.nbytes
+
+class FramePrefetcher:
+    # Decodes the next frames on worker threads while the current one is
+    # processed. Frames which were already decoded are kept in a FrameCache,
+    # so looped replays of short recordings are served from memory.
+    def __init__(self, load, depth=4, workers=2, cache_budget=0):
+        self.load = load
+        self.depth = depth
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) if depth > 0 else None
+        self.pending = {}
+        self.cache = FrameCache(cache_budget)
+        self.prefetch_hits = 0
+        self.direct_loads = 0
+
+    def get(self, key, upcoming=()):
+        frame = self.cache.get(key)
+        if frame is None:
+            future = self.pending.pop(key, None)
+            if future is not None:
+                frame = future.result()
+                self.prefetch_hits += 1
+            else:
+                frame = self.load(key)
+                self.direct_loads += 1
+            self.cache.put(key, frame)
+        self.__schedule(upcoming)
+        return frame
+
+    def __schedule(self, upcoming):
+        if self.executor is None:
+            return
+        upcoming = list(upcoming)[:self.depth]
+        for key in list(self.pending):
+            if key not in upcoming:
+                self.pending.pop(key).cancel()
+        for key in upcoming:
+            if key not in self.pending and not self.cache.contains(key):
+                self.pending[key] = self.executor.submit(self.load, key)
+
+    def stats(self):
+        return {
+            "cache_hits": self.cache.hits,
+            "cache_misses": self.cache.misses,
+            "cache_mb": self.cache.size / (1 << 20),
+            "prefetch_hits": self.prefetch_hits,
+            "direct_loads": self.direct_loads,
+        }
+
+    def close(self):
+        if self.executor is not None:
+            for future in self.pending.values():
+                future.cancel()
+            self.pending.clear()
+            self.executor.shutdown(wait=True)
@@ -0,0 +1,107 @@
+import argparse
+import concurrent.futures
+import csv
+import sys
+import time
+import aruco_core
+import replay
+
+# Headless reprocessing of one recording on a process pool. The calibration
+# events are resolved in order before the frames are split into chunks, so
+# every frame carries the perspective matrix that was active when it was
+# replayed, no matter which chunk it ends up in.
+
+HEAD = ["frame", "x1", "y1", "x2", "y2", "x3", "y3", "mid", "angle", "orig_path"]
+
+_recordings = {}
+
+def readFrame(template, is_container, key):
+    if template not in _recordings:
+        _recordings[template] = replay.Recording(template[:template.rfind('/')])
+    return _recordings[template].readFrame(key)
+
+# Runs the calibration events in the same order as Application.setInputFile()
+# replay does and returns the frames with the index of their matrix.
+def planCalibration(recording, detector):
+    matrices = []
+    frames = []
+    calibrated = False
+    previous = None
+    for kind, value in recording.events():
+        if kind == "frame":
+            frames.append((len(frames), value, len(matrices)-1 if calibrated else -1))
+            previous = value
+        elif kind == "calibration":
+            calibrated = value is not None
+            if calibrated:
+                matrices.append(value)
+        elif not calibrated:
+            frame = None
+            if previous is not None:
+                frame = readFrame(recording.template, recording.is_container, previous)
+            if frame is not None:
+                matrix = aruco_core.calibrationMatrix(detector, frame)
+                if matrix is not None:
+                    matrices.append(matrix)
+                    calibrated = True
+        else:
+            calibrated = False
+    return frames, matrices
+
+_detector = None
+
+def processChunk(template, is_container, frames, matrices):
+    global _detector
+    if _detector is None:
+        _detector = aruco_core.createDetector()
+    results = []
+    for number, key, matrix_index in frames:
+        frame = readFrame(template, is_container, key)
+        if frame is None:
+            results.append((number, key, [], -1))
+            continue
+        matrix = matrices[matrix_index] if matrix_index >= 0 else None
+        markers, angle = aruco_core.processFrame(_detector, frame, matrix)
+        results.append((number, key, markers, angle))
+    return results
+
+def resultRow(recording, result):
+    number, key, markers, angle = result
+    if len(markers) != 3:
+        points = [-1, -1, -1, -1, -1, -1]
+    else:
+        points = [value for point in markers for value in point]
+    return [number] + points + [3, angle, recording.keyName(key)]
+
+def reprocess(path, workers=None, chunk_size=256):
+    recording = replay.Recording(path)
+    frames, matrices = planCalibration(recording, aruco_core.createDetector())
+    chunks = [frames[i:i+chunk_size] for i in range(0, len(frames), chunk_size)]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(processChunk, recording.template, recording.is_container, chunk, matrices) for chunk in chunks]
+        for future in futures:
+            for result in future.result():
+                yield resultRow(recording, result)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Recompute the angles of a recording without a window, using all cores")
+    parser.add_argument("input", help = "Recording directory")
+    parser.add_argument("-o", "--output", action='store', help = "Output CSV file, standard output if not given")
+    parser.add_argument("-j", "--jobs", action='store', help = "Number of worker processes, all cores by default")
+    parser.add_argument("--chunk-size", action='store', help = "Number of frames per task")
+    args = parser.parse_args()
+
+    workers = int(args.jobs) if args.jobs != None else None
+    chunk_size = int(args.chunk_size) if args.chunk_size != None else 256
+    output_file = open(args.output, mode="w", newline="") if args.output != None else None
+    writer = csv.writer(output_file if output_file is not None else sys.stdout)
+    writer.writerow(HEAD)
+    start = time.perf_counter()
+    count = 0
+    for row in reprocess(args.input, workers, chunk_size):
+        writer.writerow(row)
+        count += 1
+    if output_file is not None:
+        output_file.close()
+        elapsed = time.perf_counter() - start
+        print(f"Processed {count} frames in {elapsed:.1f} s ({count/max(elapsed, 1e-9):.1f} fps)")
@@ -0,0 +1,97 @@
+import numpy
+
+class RoiTracker:
+    # After the expected markers have been found on the full frame, only padded
+    # crops around their previous positions are searched. Corners are shifted
+    # back into frame coordinates, so the result matches detectMarkers().
+    #   immediate - a lost marker triggers a full-frame search on the same frame
+    #   next      - the partial result is returned and the next frame is searched in full
+    POLICIES = ("immediate", "next")
+
+    def __init__(self, detector, expected, padding=1.0, fallback="immediate"):
+        if fallback not in RoiTracker.POLICIES:
+            raise ValueError(f"Unknown fallback policy '{fallback}', expected one of {RoiTracker.POLICIES}")
+        self.detector = detector
+        self.expected = dict(expected) # {id: count}
+        self.padding = padding
+        self.fallback = fallback
+        self.previous = None
+        self.roi_hits = 0
+        self.full_frame_detections = 0
+        self.fallbacks = 0
+
+    def reset(self):
+        self.previous = None
+
+    def detectMarkers(self, frame):
+        if self.previous is not None:
+            corners, ids = self.__detectRois(frame)
+            if self.__locked(ids):
+                self.roi_hits += 1
+                self.__remember(corners, ids)
+                return corners, ids
+            self.fallbacks += 1
+            self.previous = None
+            if self.fallback == "next":
+                return corners, ids
+        corners, ids, _ = self.detector.detectMarkers(frame)
+        self.full_frame_detections += 1
+        if self.__locked(ids):
+            self.__remember(corners, ids)
+        return corners, ids
+
+    def stats(self):
+        return {
+            "roi_hits": self.roi_hits,
+            "full_frame": self.full_frame_detections,
+            "fallbacks": self.fallbacks,
+        }
+
+    def __locked(self, ids):
+        if ids is None:
+            return False
+        ids = numpy.asarray(ids).flatten()
+        return all(numpy.count_nonzero(ids == id) >= count for id, count in self.expected.items())
+
+    def __remember(self, corners, ids):
+        self.previous = [corners[i] for i in range(len(corners)) if int(numpy.asarray(ids).flatten()[i]) in self.expected]
+
+    def __rois(self, shape):
+        rois = []
+        for c in self.previous:
+            c = c.reshape(-1, 2)
+            low = c.min(axis=0)
+            high = c.max(axis=0)
+            pad = self.padding * max(high - low)
+            x0, y0 = numpy.maximum(low - pad, 0).astype(int)
+            x1, y1 = numpy.minimum(high + pad, [shape[1], shape[0]]).astype(int)
+            rois.append([x0, y0, x1, y1])
+        # overlapping crops are merged so a marker is not detected twice
+        merged = True
+        while merged:
+            merged = False
+            for i in range(len(rois)):
+                for j in range(i+1, len(rois)):
+                    a, b = rois[i], rois[j]
+                    if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                        rois[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                        del rois[j]
+                        merged = True
+                        break
+                if merged:
+                    break
+        return rois
+
+    def __detectRois(self, frame):
+        corners = []
+        ids = []
+        for x0, y0, x1, y1 in self.__rois(frame.shape):
+            roi_corners, roi_ids, _ = self.detector.detectMarkers(frame[y0:y1, x0:x1])
+            if roi_ids is None:
+                continue
+            for c, id in zip(roi_corners, numpy.asarray(roi_ids).flatten()):
+                corners.append(c + numpy.float32([x0, y0]))
+                ids.append([id])
+        if len(ids) == 0:
+            return (), None
+        return tuple(corners), numpy.int32(ids)